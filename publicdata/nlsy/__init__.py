@@ -1,6 +1,7 @@
 
+# Defined before the imports, because the modules raise it
+class NlsyError(Exception):
+    pass
 
-from .nlsy import NLSY97, NLSY79
 
-class NlsyError(Exception):
-    pass
\ No newline at end of file
+from .nlsy import NLSY97, NLSY79
@@ -6,8 +6,10 @@
 Main function for converting an NLSY download into HDF5
 """
 
+from .archive import find_member
+from .build import Build, Stage
 from .cdb import convert_cdb, extract_from_codebook
-from .h5 import convert_nlsy, load_metadata
+from .h5 import convert_mmap, convert_nlsy, load_metadata
 from pathlib import Path
 import sys
 from . import NlsyError
@@ -18,16 +20,51 @@ def main():
 
     parser.add_argument('-b', '--build', action='store_true', help='Build a full HDF5 file; runs -n -c -m, which is also equivalent to not specifying any of these args. ')
 
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='Run the selected stages even if their inputs and parameters have not changed')
+
     parser.add_argument('-n', '--hdf', action='store_true', help='Create a new hdf5 file.')
 
-    parser.add_argument('-c', '--csv', action='store_true', help='Parse the codebook to CSV files')
+    parser.add_argument('-c', '--csv', action='store_true', help='Parse the codebook to metadata tables')
+
+    parser.add_argument('-C', '--export-csv', action='store_true',
+                        help='Also export the metadata tables to .meta.csv, .labels.csv and .rlabels.csv files')
 
     parser.add_argument('-e', '--extract', action='store_true', help='Only extract the cdb file, ignoring the cached version')
 
-    parser.add_argument('-m', '--meta', action='store_true', help='Load CSV metadata into the HDF5 file')
+    parser.add_argument('-m', '--meta', action='store_true', help='Load the metadata tables into the HDF5 file')
+
+    parser.add_argument('-p', '--parquet', action='store_true',
+                        help='Also write the survey data and metadata to a Parquet directory. Requires pyarrow')
+
+    parser.add_argument('-M', '--mmap', action='store_true',
+                        help='Also write the survey data to uncompressed, memory mapped files, for backend=\'mmap\'')
+
+    parser.add_argument('-Q', '--questions', action='store_true',
+                        help='Also export the question dataframes to a directory of Parquet files, one question at '
+                             'a time. Requires pyarrow')
+
+    parser.add_argument('--partition', choices=['base_qn', 'survey_year'], default='base_qn',
+                        help='With -Q, write a file per base question ( the default ), or a directory per base '
+                             'question with a file per survey year')
+
+    parser.add_argument('-j', '--jobs', type=int, default=2,
+                        help='Number of processes for running independent stages, such as converting the survey '
+                             'data and parsing the codebook, concurrently, and for parsing parts of large codebooks. '
+                             '1 runs the stages in order')
+
+    parser.add_argument('-P', '--profile', metavar='REPORT',
+                        help='Write the wall time, CPU time, peak memory, bytes read and written and rows and '
+                             'variables processed by each stage to a JSON file')
 
     parser.add_argument('-L','--limit', type=int, help='Set limit for number of rows processed with -e')
 
+    parser.add_argument('-l', '--layout', choices=['row', 'column'], default='row',
+                        help="Chunk layout of the survey dataset. 'column' is faster for reading questions")
+
+    parser.add_argument('-D', '--no-downcast', action='store_true',
+                        help='Store all survey columns as int32, rather than the smallest type that holds each column')
+
 
     parser.add_argument('archive', help='Path NLS download ZIP file')
 
@@ -52,102 +89,152 @@ def filemap(z):
 
     return files
 
-# convert_nlsy(base, dat_f, header_f, h5_file)
-
 def run(args):
-    import sys
 
-    base = Path(args.archive)
+    archive = Path(args.archive)
 
-    if not base.exists():
+    if not archive.exists():
         raise FileNotFoundError(args.archive)
 
-    if not base.suffix == '.zip':
+    if not archive.suffix == '.zip':
         raise NlsyError('Input file must have a .zip extension ')
 
     if not any([args.hdf, args.csv, args.extract, args.meta]) or args.build:
         args.hdf = args.csv = args.extract = args.meta = 1
 
-    if args.hdf:
-        make_hdf(args)
+    build = build_graph(archive, args)
+
+    names = [name for name, selected in (('hdf', args.hdf), ('extract', args.extract), ('cdb', args.csv),
+                                         ('meta', args.meta), ('parquet', args.parquet), ('mmap', args.mmap),
+                                         ('questions', args.questions))
+             if selected]
+
+    def cb(name, event, elapsed=None):
+        # Flush, because stages in the pool write to the same terminal
+        if event == 'current':
+            print(f"Stage '{name}' is up to date", flush=True)
+        elif event == 'start':
+            print(f"Stage '{name}' started", flush=True)
+        elif event == 'done':
+            print(f"Stage '{name}' finished in {elapsed:.1f}s", flush=True)
+
+    build.run(names, force=args.force, cb=cb, jobs=args.jobs)
+
+    if args.profile:
+        import json
 
-    if args.csv:
-        make_csv(args)
+        report = dict(build.report(names), archive=str(archive), jobs=args.jobs)
 
-    if args.extract:
-        make_extract(args)
+        with open(args.profile, 'w') as f:
+            json.dump(report, f, indent=4)
 
-    if args.meta:
-        make_meta(args)
+        print("Wrote profile report: ", args.profile)
 
-def _get_dat_file(base):
-    dat_file = next(base.glob('**/*.dat'))
 
-    if not dat_file:
-        raise FileNotFoundError(f'{base}.dat')
+def build_graph(archive, args):
+    """Return the build graph for the files in an archive. The inputs are read directly from the
+    archive, and the outputs are written to a directory named for it"""
+    from . import cdb, cdb_labels, h5, nlsy, parquet, store
 
-    return dat_file
+    base = Path(archive.stem)
 
-def _get_cdb_file(base):
-    cdb_file = next(base.glob('**/*.cdb'))
+    dat_file = find_member(archive, '.dat', base)
+    cdb_file = find_member(archive, '.cdb', base)
+    header_file = find_member(archive, '.NLSY97', base)
+    h5_file = Path(dat_file).with_suffix('.h5')
 
-    if not cdb_file:
-        raise FileNotFoundError(f'{base}.cdb')
+    for member in (dat_file, cdb_file):
+        Path(member).parent.mkdir(parents=True, exist_ok=True)
 
-    return cdb_file
+    build = Build(base.joinpath(base.name + '.build.json'))
 
-def unzip(archive):
-    from os import system
+    build.add(Stage('hdf', make_hdf, (dat_file, header_file, h5_file),
+                    dict(layout=args.layout, downcast=not args.no_downcast),
+                    inputs=[dat_file, header_file], outputs=[h5_file], code=[h5]))
 
-    unpack_dir = Path(archive.stem)
+    build.add(Stage('extract', make_extract, (cdb_file,), dict(limit=args.limit),
+                    inputs=[cdb_file], outputs=[Path(cdb_file).with_suffix('.cdb.h5')], code=[cdb],
+                    options=dict(jobs=args.jobs)))
 
-    if not unpack_dir.exists():
-        unpack_dir.mkdir(parents=True, exist_ok=True)
-        system("unzip {} -d {} ".format(str(archive),unpack_dir ))
+    csv_files = [Path(cdb_file).with_suffix(e) for e in ('.meta.csv', '.labels.csv', '.rlabels.csv')]
 
-    return unpack_dir
+    build.add(Stage('cdb', make_cdb, (cdb_file,), dict(limit=args.limit, csv=args.export_csv),
+                    outputs=[Path(cdb_file).with_suffix('.meta.h5')] + (csv_files if args.export_csv else []),
+                    deps=['extract'], code=[cdb, cdb_labels], options=dict(jobs=args.jobs)))
 
-def make_hdf(args):
+    build.add(Stage('meta', make_meta, (dat_file, header_file),
+                    inputs=[header_file], outputs=[h5_file], deps=['hdf', 'cdb'], code=[h5]))
 
-    base = unzip(Path(args.archive))
+    build.add(Stage('parquet', make_parquet, (h5_file,),
+                    outputs=[h5_file.with_suffix('.parquet')], deps=['meta'], code=[parquet, store]))
 
-    header_file = next(base.glob('**/*.NLSY97'))
+    # After 'meta' when it is selected, because HDF5 files can't be read while another
+    # process has them open for writing
+    build.add(Stage('mmap', make_mmap, (h5_file,),
+                    outputs=[h5_file.with_suffix('.mmap')], deps=['hdf', 'meta'], code=[h5]))
 
-    if not header_file:
-        raise FileNotFoundError(f'{base}.NLSY97')
+    build.add(Stage('questions', make_questions, (h5_file,), dict(partition=args.partition),
+                    outputs=[h5_file.with_suffix('.questions')], deps=['meta'], code=[parquet, nlsy, store]))
 
-    h5_file = base.joinpath(base).with_suffix('.h5')
+    return build
+
+
+def make_hdf(dat_file, header_file, h5_file, layout='row', downcast=True):
 
     print("Convert .dat file to .hdf5")
-    convert_nlsy(_get_dat_file(base), header_file, h5_file)
+    convert_nlsy(dat_file, header_file, h5_file, layout=layout, downcast=downcast)
 
     print("Wrote HDF5 file: ", h5_file)
 
 
-def make_csv(args):
-    base = unzip(Path(args.archive))
+def make_cdb(cdb_file, limit=None, csv=False, jobs=1):
 
-    print("Create .csv files from codebook")
-    wrote_files = convert_cdb(_get_cdb_file(base))
+    print("Create metadata tables from codebook")
+    wrote_files = convert_cdb(cdb_file, limit=limit, jobs=jobs, csv=csv)
 
     for f in wrote_files:
         print("Wrote  ",f)
 
-def make_extract(args):
-
-    base = unzip(Path(args.archive))
+def make_extract(cdb_file, limit=None, jobs=1):
 
     print("Extract codebook to a datastructure")
 
-    extract_from_codebook(_get_cdb_file(base), force=True, limit=args.limit)
+    extract_from_codebook(cdb_file, force=True, limit=limit, jobs=jobs)
+
+
+def make_meta(dat_file, header_file):
+
+    print("Load metadata into the HDF5 file")
+    load_metadata(dat_file, header_file)
+
+
+def make_parquet(h5_file):
+    from .parquet import convert_parquet
+
+    print("Convert HDF5 file to Parquet")
+    parquet_dir = convert_parquet(h5_file)
+
+    print("Wrote Parquet directory: ", parquet_dir)
+
+
+def make_mmap(h5_file):
+
+    print("Write memory mapped survey data")
+    mmap_dir = convert_mmap(h5_file)
+
+    print("Wrote memory mapped directory: ", mmap_dir)
 
 
-def make_meta(args):
+def make_questions(h5_file, partition='base_qn'):
+    from .nlsy import NLSY97
 
-    base = unzip(Path(args.archive))
+    print("Export question dataframes to Parquet")
 
-    load_metadata(_get_dat_file(base))
+    with NLSY97(h5_file) as nlsy:
+        files = nlsy.export_questions(h5_file.with_suffix('.questions'), partition=partition)
 
+    print("Wrote {} question files to: {}".format(sum(len(e) for e in files.values()),
+                                                  h5_file.with_suffix('.questions')))
 
 
 
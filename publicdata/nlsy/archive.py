@@ -0,0 +1,107 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# MIT License, included in this distribution as LICENSE
+
+"""
+Read the files in an NLSY download ZIP archive without extracting them
+"""
+
+import io
+import os
+from pathlib import Path, PurePosixPath
+from zipfile import ZipFile
+
+
+class ArchiveMember(os.PathLike):
+    """A file in a ZIP archive, which is decompressed as it is read.
+
+    As a path, the member is the file it would be extracted to, in a directory named for the
+    archive, so functions that name their outputs after their inputs, with Path(f).with_suffix(),
+    write next to where the member would be. Open it with open_file(), or the open() method, not
+    with the builtin open()
+    """
+
+    def __init__(self, archive, member, extract_dir=None):
+        self.archive = Path(archive)
+        self.member = member
+        self.extract_dir = Path(extract_dir) if extract_dir else Path(self.archive.stem)
+
+    @property
+    def path(self):
+        """Path the member would be extracted to"""
+        return self.extract_dir.joinpath(self.member)
+
+    def __fspath__(self):
+        return str(self.path)
+
+    def __str__(self):
+        return str(self.path)
+
+    def __repr__(self):
+        return f'<ArchiveMember {self.archive}:{self.member}>'
+
+    def __eq__(self, other):
+        return isinstance(other, ArchiveMember) and (self.archive, self.member) == (other.archive, other.member)
+
+    def __hash__(self):
+        return hash((self.archive, self.member))
+
+    @property
+    def name(self):
+        return self.path.name
+
+    @property
+    def stem(self):
+        return self.path.stem
+
+    @property
+    def suffix(self):
+        return self.path.suffix
+
+    def with_suffix(self, suffix):
+        """Return the member with the same name, but a different suffix"""
+        return ArchiveMember(self.archive, str(PurePosixPath(self.member).with_suffix(suffix)), self.extract_dir)
+
+    @property
+    def info(self):
+        with ZipFile(self.archive) as zf:
+            return zf.getinfo(self.member)
+
+    def exists(self):
+        with ZipFile(self.archive) as zf:
+            return self.member in zf.namelist()
+
+    def open(self, mode='r'):
+        """Open the member for streaming reads, in text or binary ( 'rb' ) mode"""
+
+        if not mode.startswith('r'):
+            raise ValueError('Archive members can only be opened for reading')
+
+        zf = ZipFile(self.archive)
+
+        try:
+            # The member file keeps the archive file open until it is closed
+            f = zf.open(self.member)
+        finally:
+            zf.close()
+
+        return f if 'b' in mode else io.TextIOWrapper(f)
+
+
+def find_member(archive, suffix, extract_dir=None):
+    """Return the first member of an archive with the given suffix"""
+
+    with ZipFile(archive) as zf:
+        for name in zf.namelist():
+            if PurePosixPath(name).suffix == suffix:
+                return ArchiveMember(archive, name, extract_dir)
+
+    raise FileNotFoundError(f'{archive}:*{suffix}')
+
+
+def open_file(path, mode='r'):
+    """Open a file, which may be an ArchiveMember"""
+
+    if isinstance(path, ArchiveMember):
+        return path.open(mode)
+    else:
+        return open(path, mode)
@@ -0,0 +1,228 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# MIT License, included in this distribution as LICENSE
+
+"""
+Benchmarks for building and reading NLSY HDF5 files
+
+Compare HDF5 layouts for an NLSY download:
+
+    python -m publicdata.nlsy.benchmark test-package.dat test-package.NLSY97 -m test-package.meta.h5
+
+Time each stage of the build, and the query functions, on synthetic downloads of several sizes:
+
+    python -m publicdata.nlsy.benchmark -s small -s medium -j results.json
+
+"""
+
+import json
+import random
+from pathlib import Path
+from statistics import mean, median
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import h5py
+import pandas as pd
+
+from .h5 import chunk_cache_size, convert_nlsy
+from .store import Hdf5Store
+
+# Sizes of synthetic downloads for bench_suite(), as synthetic.write_synthetic() parameters
+SCALES = {
+    'small': dict(respondents=1000, variables=200, label_sets=20),
+    'medium': dict(respondents=5000, variables=2000, label_sets=100),
+    'large': dict(respondents=20000, variables=10000, label_sets=400),
+}
+
+
+def question_columns(ncols, meta_file=None, n=100, seed=0):
+    """Return a list of column number lists, one per question. If a .meta.h5 or .meta.csv file is given,
+    the questions are the base questions from the codebook, otherwise they are random groups
+    of 1 to 10 columns"""
+
+    rand = random.Random(seed)
+
+    if meta_file:
+        if Path(meta_file).suffix == '.h5':
+            from .h5 import read_table
+
+            with h5py.File(meta_file, 'r') as f:
+                meta = read_table(f, 'variable_labels', ['col_no', 'base_qn'])
+        else:
+            meta = pd.read_csv(meta_file, low_memory=False)
+        questions = [sorted(int(c) for c in g.col_no if c < ncols) for _, g in meta.groupby('base_qn')]
+        questions = [q for q in questions if q]
+    else:
+        questions = [sorted(rand.sample(range(ncols), rand.randint(1, min(10, ncols)))) for _ in range(n)]
+
+    rand.shuffle(questions)
+
+    return questions[:n]
+
+
+def time_question_reads(h5_file, questions, chunk_cache='auto'):
+    """Time reading the columns for each question, as NLSY.get_dataframe() does. Each question
+    is read once with a fresh chunk cache. Returns a list of latencies in seconds"""
+
+    base = Path(h5_file).stem
+
+    if chunk_cache == 'auto':
+        with h5py.File(h5_file, 'r') as f:
+            chunk_cache = chunk_cache_size(f[base])
+
+    times = []
+
+    for col_nos in questions:
+        with h5py.File(h5_file, 'r', **(chunk_cache or {})) as f:
+            store = Hdf5Store(f, base)
+            t = perf_counter()
+            store.read_columns(col_nos)
+            times.append(perf_counter() - t)
+
+    return times
+
+
+def bench_layouts(dat_file, header_file, meta_file=None, layouts=('row', 'column'), downcast=(False, True),
+                  n=100, seed=0):
+    """Build an HDF5 file for each layout, with and without downcasting, and time per-question reads"""
+
+    with open(header_file) as f:
+        ncols = len(f.readlines())
+
+    questions = question_columns(ncols, meta_file, n=n, seed=seed)
+
+    results = []
+
+    with TemporaryDirectory() as td:
+        for layout, dc in [(layout, dc) for layout in layouts for dc in downcast]:
+            h5_file = Path(td).joinpath(Path(dat_file).stem + '.h5')
+
+            t = perf_counter()
+            convert_nlsy(dat_file, header_file, h5_file, layout=layout, downcast=dc)
+            build_time = perf_counter() - t
+
+            times = sorted(time_question_reads(h5_file, questions))
+
+            results.append({
+                'layout': layout,
+                'downcast': dc,
+                'build_s': build_time,
+                'file_bytes': h5_file.stat().st_size,
+                'questions': len(times),
+                'mean_ms': mean(times) * 1000,
+                'median_ms': median(times) * 1000,
+                'p95_ms': times[int(len(times) * .95)] * 1000,
+                'max_ms': times[-1] * 1000
+            })
+
+            h5_file.unlink()
+
+    return results
+
+
+def _timings(scale, params, stage, times):
+    times = sorted(times)
+
+    return dict(scale=scale, **params, stage=stage, calls=len(times),
+                total_s=sum(times),
+                mean_ms=mean(times) * 1000,
+                median_ms=median(times) * 1000,
+                max_ms=times[-1] * 1000)
+
+
+def _timed(func, *args, **kwargs):
+    t = perf_counter()
+    v = func(*args, **kwargs)
+    return v, perf_counter() - t
+
+
+def bench_suite(scales=('small',), n=20, seed=0, work_dir=None):
+    """Write a synthetic download for each scale, time each stage of building it, then time
+    NLSY.get_dataframe(), NLSY.question_dataframe() and NLSY.categoricalize() for `n` base questions.
+
+    Scales are names in SCALES, or dicts of synthetic.write_synthetic() parameters. Returns a list of
+    dicts, one per scale and stage, with the number of calls and their latencies"""
+
+    from .cdb import convert_cdb, extract_from_codebook
+    from .h5 import load_metadata
+    from .nlsy import NLSY97
+    from .synthetic import write_synthetic
+
+    results = []
+
+    for scale in scales:
+        params = SCALES[scale] if isinstance(scale, str) else dict(scale)
+        name = scale if isinstance(scale, str) else 'custom'
+
+        with TemporaryDirectory(dir=work_dir) as td:
+            dat_file, cdb_file, header_file = write_synthetic(td, seed=seed, **params)
+            h5_file = dat_file.with_suffix('.h5')
+
+            for stage, func, args in (('convert_nlsy', convert_nlsy, (dat_file, header_file, h5_file)),
+                                      ('extract_from_codebook', extract_from_codebook, (cdb_file, None, True)),
+                                      ('convert_cdb', convert_cdb, (cdb_file,)),
+                                      ('load_metadata', load_metadata, (dat_file, header_file))):
+                _, t = _timed(func, *args)
+                results.append(_timings(name, params, stage, [t]))
+
+            with NLSY97(h5_file) as nlsy:
+                # Load the metadata and respondent columns first, so they are not in the first query
+                nlsy.respondent_meta
+
+                base_qns = sorted(set(nlsy.metadata.base_qn.dropna()) - set(nlsy.respondent_cols))
+                base_qns = random.Random(seed).sample(base_qns, min(n, len(base_qns)))
+
+                times = [_timed(nlsy.get_dataframe, nlsy.base_question_columns(qn))[1] for qn in base_qns]
+                results.append(_timings(name, params, 'get_dataframe', times))
+
+                frames, times = zip(*[_timed(nlsy.question_dataframe, qn) for qn in base_qns])
+                results.append(_timings(name, params, 'question_dataframe', times))
+
+                times = [_timed(nlsy.categoricalize, df)[1] for df in frames]
+                results.append(_timings(name, params, 'categoricalize', times))
+
+    return results
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark NLSY HDF5 layouts, or, with --scale, '
+                                                 'the build and query functions on synthetic data')
+
+    parser.add_argument('-s', '--scale', action='append', choices=list(SCALES),
+                        help='Run the benchmark suite on a synthetic download of this size. May be repeated')
+
+    parser.add_argument('-m', '--meta', help='.meta.h5 or .meta.csv file, to select base questions')
+
+    parser.add_argument('-n', '--questions', type=int, default=100, help='Number of questions to read')
+
+    parser.add_argument('-j', '--json', help='Write the results to a JSON file')
+
+    parser.add_argument('dat_file', nargs='?', help='.dat file')
+
+    parser.add_argument('header_file', nargs='?', help='.NLSY97 or .NLSY79 header file')
+
+    args = parser.parse_args()
+
+    if args.scale:
+        results = bench_suite(args.scale, n=args.questions)
+
+        print(pd.DataFrame(results).set_index(['scale', 'stage'])
+              [['calls', 'total_s', 'mean_ms', 'median_ms', 'max_ms']].round(3).to_string())
+
+    elif args.dat_file and args.header_file:
+        results = bench_layouts(args.dat_file, args.header_file, args.meta, n=args.questions)
+
+        print(pd.DataFrame(results).set_index(['layout', 'downcast']).round(3).to_string())
+
+    else:
+        parser.error('Either --scale, or the .dat and header files, are required')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# MIT License, included in this distribution as LICENSE
+
+"""
+An incremental build graph for converting NLSY downloads.
+
+Each stage records a key in a JSON manifest, which is a hash of the content of its
+input files, its parameters, the source of the modules that implement it and the keys and
+stamps of the stages it depends on. A stage only runs when its key changes or one of its
+outputs is missing. A stamp is recorded each time a stage runs, so when a stage runs again,
+even with the same key, the stages that depend on it run too.
+
+Each stage that runs is measured with instrument.measure(), and the measurements are recorded
+in the manifest, and returned by Build.report().
+"""
+
+import hashlib
+import json
+import sys
+import uuid
+from pathlib import Path
+
+from .archive import ArchiveMember, open_file
+
+
+def file_hash(path, block_size=2 ** 24):
+    """Return the SHA-256 hex digest of a file's contents. Archive members are identified by
+    the CRC and size in the archive directory, so they are not read"""
+
+    if isinstance(path, ArchiveMember):
+        info = path.info
+        return f'crc32:{info.CRC:08x}:{info.file_size}'
+
+    h = hashlib.sha256()
+
+    with open_file(path, 'rb') as f:
+        while True:
+            b = f.read(block_size)
+            if not b:
+                break
+            h.update(b)
+
+    return h.hexdigest()
+
+
+class Stage(object):
+    """A step in the build. `func` is called with `args`, `kwargs` and `options`, and must be a
+    module level function. `kwargs` are also the stage's parameters, so they must be
+    JSON serializable. `options` are keyword arguments that don't change the outputs, such as
+    the number of processes to use, so they are not part of the key"""
+
+    def __init__(self, name, func, args=(), kwargs=None, inputs=(), outputs=(), deps=(), code=(), options=None):
+        self.name = name
+        self.func = func
+        self.args = tuple(args)
+        self.kwargs = kwargs or {}
+        self.options = options or {}
+        self.inputs = list(inputs)  # Files whose content is part of the key
+        self.outputs = [Path(e) for e in outputs]  # Files that must exist for the stage to be current
+        self.deps = list(deps)  # Names of stages that must run first
+        self.code = list(code)  # Modules whose source is part of the key
+
+    def run(self):
+        return self.func(*self.args, **self.kwargs, **self.options)
+
+    def __repr__(self):
+        return f'<Stage {self.name}>'
+
+
+class Build(object):
+    """A graph of stages, with a manifest file that records the key of each stage
+    when it last completed"""
+
+    def __init__(self, manifest_file):
+        self.manifest_file = Path(manifest_file)
+        self.stages = {}
+
+        if self.manifest_file.exists():
+            with self.manifest_file.open() as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {}
+
+        self.manifest.setdefault('stages', {})
+        self.manifest.setdefault('files', {})
+
+        self._keys = {}
+        self.metrics = {}  # Measurements of the stages run by this build
+        self.elapsed = None  # Wall time of the last run
+
+    def add(self, stage):
+        self.stages[stage.name] = stage
+        return stage
+
+    def save(self):
+        tmp = self.manifest_file.with_suffix('.tmp')
+
+        with tmp.open('w') as f:
+            json.dump(self.manifest, f, indent=4, sort_keys=True)
+
+        tmp.replace(self.manifest_file)
+
+    def file_hash(self, path):
+        """Hash a file, reusing the hash recorded in the manifest if the file's size and
+        modification time have not changed"""
+
+        if isinstance(path, ArchiveMember):
+            return file_hash(path)
+
+        path = Path(path)
+        st = path.stat()
+        stat = [st.st_size, st.st_mtime_ns]
+
+        entry = self.manifest['files'].get(str(path))
+
+        if entry and entry['stat'] == stat:
+            return entry['hash']
+
+        h = file_hash(path)
+
+        self.manifest['files'][str(path)] = {'stat': stat, 'hash': h}
+
+        return h
+
+    def key(self, name):
+        """Return the key of a stage"""
+        import inspect
+
+        if name not in self._keys:
+            stage = self.stages[name]
+
+            d = {
+                'params': stage.kwargs,
+                'args': [str(e) for e in stage.args],
+                'inputs': {str(p): self.file_hash(p) for p in stage.inputs},
+                'code': {m.__name__: hashlib.sha256(inspect.getsource(m).encode('utf8')).hexdigest()
+                         for m in stage.code},
+                'deps': {dep: [self.key(dep), self.stamp(dep)] for dep in stage.deps}
+            }
+
+            self._keys[name] = hashlib.sha256(json.dumps(d, sort_keys=True, default=str).encode('utf8')).hexdigest()
+
+        return self._keys[name]
+
+    def stamp(self, name):
+        """Return the stamp recorded the last time a stage ran, or None"""
+        return self.manifest['stages'].get(name, {}).get('stamp')
+
+    def is_current(self, name):
+        """True if the stage's key matches the one recorded the last time it ran, and all
+        of its outputs exist"""
+
+        stage = self.stages[name]
+
+        return (self.manifest['stages'].get(name, {}).get('key') == self.key(name) and
+                all(p.exists() for p in stage.outputs))
+
+    def order(self, names=None):
+        """Return the stages in dependency order, limited to `names` if given"""
+
+        ordered = []
+
+        def visit(name):
+            if name in ordered:
+                return
+            for dep in self.stages[name].deps:
+                if dep in self.stages:
+                    visit(dep)
+            ordered.append(name)
+
+        for name in self.stages:
+            visit(name)
+
+        return [n for n in ordered if names is None or n in names]
+
+    def run(self, names=None, force=False, cb=None, jobs=1):
+        """Run the stages that are not current, in dependency order, and return the
+        names of the stages that ran, in the order they finished. `cb` is called with each
+        stage name and an event: 'current' if the stage will not run, 'start' when it
+        starts and 'done' when it finishes, with the elapsed seconds as a third argument.
+        The measurements of the stages that ran are in self.metrics.
+
+        With `jobs` greater than 1, stages run in a pool of that many processes, and a stage
+        starts as soon as the stages it depends on have finished and there is a free process,
+        so up to `jobs` independent stages run concurrently"""
+
+        from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+        from time import perf_counter
+
+        cb = cb or (lambda name, event, elapsed=None: None)
+
+        t = perf_counter()
+
+        pending = self.order(names)
+        finished = set()
+        running = {}
+        ran = []
+
+        def ready(name):
+            active = set(pending) | {n for n, _ in running.values()}
+            return all(dep in finished or dep not in active for dep in self.stages[name].deps)
+
+        def complete(name, metrics, output=None):
+            if output:
+                sys.stdout.write(output)
+                sys.stdout.flush()
+
+            self._keys = {}  # Input files may have changed
+            self.manifest['stages'][name] = {'key': self.key(name), 'stamp': uuid.uuid4().hex,
+                                             'elapsed': metrics['wall_time'], 'metrics': metrics}
+            self.save()
+
+            self.metrics[name] = metrics
+
+            finished.add(name)
+            ran.append(name)
+            cb(name, 'done', metrics['wall_time'])
+
+        pool = ProcessPoolExecutor(jobs) if jobs > 1 else None
+
+        try:
+            while pending or running:
+
+                for name in [n for n in pending if ready(n)]:
+
+                    # Upstream stages may have run, which changes the key
+                    self._keys = {}
+
+                    if not force and self.is_current(name):
+                        pending.remove(name)
+                        finished.add(name)
+                        cb(name, 'current')
+                        continue
+
+                    if pool and len(running) >= jobs:
+                        continue  # Stays pending until a running stage finishes
+
+                    pending.remove(name)
+
+                    cb(name, 'start')
+
+                    stage = self.stages[name]
+
+                    if pool:
+                        position = min(set(range(jobs)) - {p for _, p in running.values()})
+                        future = pool.submit(_run_stage, stage.func, stage.args, dict(stage.kwargs, **stage.options),
+                                             position)
+                        running[future] = (name, position)
+                    else:
+                        complete(name, *_run_stage(stage.func, stage.args, dict(stage.kwargs, **stage.options)))
+
+                if running:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                    for future in done:
+                        name, _ = running.pop(future)
+                        complete(name, *future.result())
+
+        finally:
+            if pool:
+                pool.shutdown(cancel_futures=True)
+
+            self.elapsed = perf_counter() - t
+
+        return ran
+
+    def report(self, names=None):
+        """Return a dict of the stages, in dependency order, with whether each one ran in the last call
+        to run() and its measurements, from that run or the last time it ran"""
+
+        stages = {}
+
+        for name in self.order(names):
+            if name in self.metrics:
+                stages[name] = dict(self.metrics[name], ran=True)
+            else:
+                stages[name] = dict(self.manifest['stages'].get(name, {}).get('metrics', {}), ran=False)
+
+        return {
+            'manifest': str(self.manifest_file),
+            'wall_time': round(self.elapsed, 3) if self.elapsed is not None else None,
+            'stages': stages
+        }
+
+
+def _run_stage(func, args, kwargs, position=None):
+    """Run a stage's function, and return its measurements, from instrument.measure(), and its output.
+    When the stage runs in a pool, `position` is the line its progress bars are drawn on, so concurrent
+    stages don't overwrite each other, and what it prints is returned, to be written when it finishes,
+    rather than mixed with the output of the other stages. Otherwise the output is None"""
+    import io
+    import os
+    from contextlib import nullcontext, redirect_stdout
+    from .instrument import measure
+
+    output = None
+
+    if position is not None:
+        os.environ['TQDM_POSITION'] = str(position)
+        output = io.StringIO()
+
+    try:
+        with redirect_stdout(output) if output is not None else nullcontext():
+            _, metrics = measure(func, *args, **kwargs)
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+    return metrics, output.getvalue() if output is not None else None
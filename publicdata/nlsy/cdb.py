@@ -5,14 +5,15 @@
 Functions for converting the code book, the .cdb file
 """
 
-import csv
-import hashlib
-import pickle
 from pathlib import Path
 import re
+
+import pandas as pd
 from tqdm import tqdm
 
-from .cdb_labels import get_remap_dict, process_value_labels
+from .archive import ArchiveMember, open_file
+from .instrument import count
+from .cdb_labels import LabelFeatureStore, get_remap_dict, process_value_labels
 
 
 def pair_slugify(e):
@@ -59,17 +60,60 @@ def split_dims(qn):
     return [base_qn + ('~' + component if component else '')] + dims + [component]
 
 
+# Version of the codebook parser. Change it when the parser's output changes, to invalidate cached extractions
+PARSER_VERSION = 1
+
+# Patterns for the codebook parser, compiled once
+_response_choice_re = re.compile('RESPONSE CHOICE: \"([^\"]+)\"')
+_var_level_re = re.compile('(PRIMARY|SECONDARY|TERTIARY) VARIABLE')
+_summation_re = re.compile(r'\-{5,20}')
+_label_start_re = re.compile(r'^\s{4,8}\d')
+_group_re = re.compile(r'[\!\-\~\.\_\d]')
+
+# Number of lines between progress callbacks
+_progress_lines = 10000
+
+
+def _decoded_lines(f, encoding='utf8'):
+    """Yield the lines of a text or binary file as strings, with the number of bytes each one
+    was read from. Binary lines are decoded as a text file would decode them, with universal newlines"""
+
+    for l in f:
+        if isinstance(l, bytes):
+            n = len(l)
+            l = l.decode(encoding, errors='replace')
+            if l.endswith('\r\n'):
+                l = l[:-2] + '\n'
+            yield n, l
+        else:
+            yield len(l), l
+
+
 def _extract_from_codebook(f, cb=None, limit=None):
     """
     Parse the codebook for the NYLS79 full dataset, downloadable from
     https://www.nlsinfo.org/accessing-data-cohorts
 
+    The codebook is parsed in a single pass as it is read, so `f` may be a stream.
 
-    :param f:
-    :return:
+    :param f: Codebook file, opened in binary or text mode
+    :param cb: Called periodically with the number of bytes read since the last call
+    :param limit: Stop at the first question that ends after this line number
+    :return: List of dicts, one per variable
     """
 
-    import re
+    vars, var, _, _ = _parse_codebook(f, cb, limit)
+
+    if var:  # Maybe last line doesn't have h-rule marker
+        vars.append(var)
+
+    return vars
+
+
+def _parse_codebook(f, cb=None, limit=None):
+    """Parse a codebook, or part of one, for _extract_from_codebook(). Returns the variables that
+    ended with an h-rule, the last variable, the number of variables and True if the parse ended inside
+    a block of value labels, in which case the labels would continue into the next part of the file"""
 
     vars = []
     var = None
@@ -82,9 +126,14 @@ def _extract_from_codebook(f, cb=None, limit=None):
     if not cb:
         cb = lambda v: None
 
-    for line_no, l in enumerate(f.readlines()):
+    n_bytes = 0
 
-        cb(line_no)
+    for line_no, (n, l) in enumerate(_decoded_lines(f)):
+
+        n_bytes += n
+        if line_no % _progress_lines == 0:
+            cb(n_bytes)
+            n_bytes = 0
 
         if 'Survey Year' in l and 'COMMENT' not in l:
             var_line = 0
@@ -95,7 +144,7 @@ def _extract_from_codebook(f, cb=None, limit=None):
 
             base_qn, *dims, component = split_dims(qn)
 
-            question_group, *_ = re.sub('[\!\-\~\.\_\d]', '-', base_qn).split('-')
+            question_group, *_ = _group_re.sub('-', base_qn).split('-')
 
             var = {
                 'var_no': var_no,
@@ -120,23 +169,22 @@ def _extract_from_codebook(f, cb=None, limit=None):
 
             var_labels_done = False
 
-        if len(l.strip()) == 0:
-            pass
-
         if var_line == 4:
             var['question'] = l.strip()
 
-        m = re.search('RESPONSE CHOICE: \"([^\"]+)\"', l)
+        if 'RESPONSE CHOICE' in l:
+            m = _response_choice_re.search(l)
 
-        if m:
-            var['response_choice'] = m.group(1)
+            if m:
+                var['response_choice'] = m.group(1)
 
-        m = re.search('(PRIMARY|SECONDARY|TERTIARY) VARIABLE', l)
-        if m:
-            var['var_level'] = m.group(1)
+        if 'VARIABLE' in l:
+            m = _var_level_re.search(l)
+            if m:
+                var['var_level'] = m.group(1)
 
         # Mark the indented value labels
-        if re.match(r'\-{5,20}', l.strip()) and in_val_labels:  # '-----', the summation line for value counts
+        if in_val_labels and _summation_re.match(l.strip()):  # '-----', the summation line for value counts
             # Marks end of value label
             in_val_labels = False
             var_labels_done = True
@@ -144,7 +192,7 @@ def _extract_from_codebook(f, cb=None, limit=None):
             var_label_lines = []
             continue
 
-        elif re.match(r'^\s{4,8}\d', l) and not var_label_lines and not var_labels_done:
+        elif not var_label_lines and not var_labels_done and _label_start_re.match(l):
             in_val_labels = True
 
         if in_val_labels:
@@ -157,176 +205,407 @@ def _extract_from_codebook(f, cb=None, limit=None):
             if var:
                 vars.append(var)
 
-            v = None
-
             if limit is not None:
                 if line_no > limit:
                     break
 
         var_line += 1
 
-    if var:  # Maybe last line doesn't have h-rule marker
+    cb(n_bytes)
+
+    return vars, var, var_no, in_val_labels or bool(var_label_lines)
+
+
+def _chunk_offsets(cdb_file, size, n):
+    """Return the byte offsets of up to `n` parts of the codebook. Each part, other than the first,
+    starts with the header line of a variable, immediately after an h-rule"""
+
+    offsets = [0]
+
+    with open_file(cdb_file, 'rb') as f:
+        for k in range(1, n):
+            start = max(k * size // n, offsets[-1])
+            f.seek(start)
+            f.readline()  # Probably a partial line
+
+            last = b''
+            while True:
+                pos = f.tell()
+                l = f.readline()
+
+                if not l:
+                    break
+
+                if b'---------------------------------' in last and b'Survey Year' in l and b'COMMENT' not in l:
+                    offsets.append(pos)
+                    break
+
+                last = l
+
+    return sorted(set(offsets)) + [size]
+
+
+def _extract_chunk(cdb_file, start, end):
+    """Parse the part of the codebook between two byte offsets"""
+    import io
+
+    with open_file(cdb_file, 'rb') as f:
+        f.seek(start)
+        return _parse_codebook(io.BytesIO(f.read(end - start))), end - start
+
+
+def _extract_parallel(cdb_file, size, jobs, chunk_bytes, cb):
+    """Parse parts of the codebook in a pool of processes, and merge them. Returns None if
+    the parts can't be merged, because one of them ended in the middle of value labels"""
+    from concurrent.futures import ProcessPoolExecutor
+
+    offsets = _chunk_offsets(cdb_file, size, min(jobs * 2, -(-size // chunk_bytes)))
+
+    with ProcessPoolExecutor(jobs) as pool:
+        futures = [pool.submit(_extract_chunk, cdb_file, start, end) for start, end in zip(offsets, offsets[1:])]
+
+        chunks = []
+        for future in futures:
+            chunk, n = future.result()
+            chunks.append(chunk)
+            cb(n)
+
+    if any(open_labels for _, _, _, open_labels in chunks[:-1]):
+        return None
+
+    vars = []
+    var_no = 0
+
+    for chunk_vars, var, n_vars, _ in chunks:
+        # Each part numbers its variables from 1. The last variable may be in the list twice
+        for v in {id(v): v for v in chunk_vars + ([var] if var else [])}.values():
+            v['var_no'] += var_no
+            v['col_no'] += var_no
+
+        vars.extend(chunk_vars)
+        var_no += n_vars
+
+    if var:
         vars.append(var)
 
     return vars
 
 
-def extract_from_codebook(cdb_file, limit=None, force=False):
-    """Extract the code book to a data structure, cached on disk"""
+def _codebook_cache_key(cdb_file, limit):
+    """Attributes that identify the codebook, parser and parameters a cached extraction was made with"""
+    from .build import file_hash
+
+    return {
+        'source_hash': file_hash(cdb_file),
+        'parser_version': PARSER_VERSION,
+        'limit': -1 if limit is None else int(limit)
+    }
+
+
+def write_codebook_cache(cache_file, vars, key):
+    """Write the extracted codebook variables to an HDF5 file, as a table with one row per variable,
+    and a table of the value label lines of all of the variables, in order. The `key` dict
+    is stored as attributes of the file"""
+    import h5py
+    from .h5 import write_table
 
-    pkl_file = Path(cdb_file).with_suffix('.cdb.pkl')
+    keys = list(dict.fromkeys(k for v in vars for k in v))
 
-    cdb_length = sum(1 for _ in open(cdb_file))
+    # Columns for keys that only some variables have, so they can be left out when reading
+    partial = [k for k in keys if any(k not in v for v in vars)]
 
-    if not pkl_file.exists() or force:
+    df = pd.DataFrame({k: [len(v.get(k, ())) if k == 'label_lines' else v.get(k) for v in vars] for k in keys})
 
-        with open(cdb_file) as f:
-            extract_progress = tqdm(total=cdb_length, desc='Extract  ', ncols=80)
-            v = _extract_from_codebook(f, cb=lambda l: extract_progress.update(), limit=limit)
-            extract_progress.close()
+    for k in partial:
+        df['_has_' + k] = [k in v for v in vars]
 
-        with pkl_file.open('wb') as f:
-            pickle.dump(v, f)
+    lines = pd.DataFrame({'line': [l for v in vars for l in v.get('label_lines', ())]})
 
-        return v
+    tmp_file = Path(cache_file).with_suffix('.tmp')
 
+    with h5py.File(tmp_file, 'w') as f:
+        write_table(f, 'variables', df)
+        write_table(f, 'label_lines', lines)
+
+        f.attrs['keys'] = keys
+        f.attrs['partial'] = partial
+        f.attrs.update(key)
+
+    tmp_file.replace(cache_file)
+
+
+def read_codebook_cache(cache_file, key=None):
+    """Read the variables written by write_codebook_cache(). Returns None if the file does not exist,
+    or its attributes don't match `key`"""
+    import h5py
+    from .h5 import read_table
+
+    if not Path(cache_file).exists():
+        return None
+
+    with h5py.File(cache_file, 'r') as f:
+        if key and any(f.attrs.get(k) != v for k, v in key.items()):
+            return None
+
+        keys = list(f.attrs['keys'])
+        partial = set(f.attrs['partial'])
+
+        df = read_table(f, 'variables')
+        lines = read_table(f, 'label_lines')['line'].tolist()
+
+    columns = []
+
+    for k in keys:
+        c = df[k]
+
+        if k == 'label_lines':
+            ends = c.cumsum().tolist()
+            columns.append([lines[e - n:e] for n, e in zip(c.tolist(), ends)])
+        elif pd.api.types.is_numeric_dtype(c) and not c.isna().all():
+            if c.isna().any():
+                # Integers with nulls are read as floats
+                columns.append([None if e != e else int(e) if float(e).is_integer() else e for e in c.tolist()])
+            else:
+                columns.append(c.tolist())
+        else:
+            columns.append(c.astype(object).where(c.notna(), None).tolist())
+
+    vars = [dict(zip(keys, row)) for row in zip(*columns)]
+
+    for k in partial:
+        for v, has in zip(vars, df['_has_' + k].tolist()):
+            if not has:
+                del v[k]
+
+    return vars
+
+
+def extract_from_codebook(cdb_file, limit=None, force=False, jobs=1, chunk_bytes=2 ** 24):
+    """Extract the code book to a data structure, cached on disk
+
+    The cache, <name>.cdb.h5, is used when it was made from a codebook with the same content, by
+    the same version of the parser and with the same limit, otherwise the codebook is extracted again.
+
+    With `jobs` greater than 1, and no limit, parts of at least `chunk_bytes` of the codebook
+    are parsed in a pool of processes, and merged in order"""
+
+    cache_file = Path(cdb_file).with_suffix('.cdb.h5')
+
+    key = _codebook_cache_key(cdb_file, limit)
+
+    if not force:
+        v = read_codebook_cache(cache_file, key)
+
+        if v is not None:
+            return v
+
+    if isinstance(cdb_file, ArchiveMember):
+        size = cdb_file.info.file_size
     else:
+        size = Path(cdb_file).stat().st_size
 
-        with pkl_file.open('rb') as f:
-            return pickle.load(f)
+    extract_progress = tqdm(total=size, desc='Extract  ', ncols=80, unit='B', unit_scale=True)
 
+    v = None
 
-def create_label_sets(procd_val_labels):
-    rd = get_remap_dict(procd_val_labels)
+    if jobs > 1 and limit is None and size > chunk_bytes:
+        v = _extract_parallel(cdb_file, size, jobs, chunk_bytes, extract_progress.update)
 
-    labels = {}
-    qn_to_hash = {}
+        if v is None:
+            extract_progress.reset()
 
-    for qn, bqn, is_range, is_categorical, d in tqdm(procd_val_labels, desc='create label sets'):
+    if v is None:
+        with open_file(cdb_file, 'rb') as f:
+            v = _extract_from_codebook(f, cb=extract_progress.update, limit=limit)
 
-        if is_categorical:
+    extract_progress.close()
 
-            for k, v in list(d.items()):
-                d[k] = rd.get(qn + ':' + k, {}).get(k, v)
+    count(variables=len(v))
+
+    write_codebook_cache(cache_file, v, key)
+
+    return v
+
+
+class LabelSets(object):
+    """Intern label sets, dicts of value to label, by their content, so each distinct set gets one
+    integer id, in the order the sets are first seen. Sets with the same values and labels, after
+    slugifying the labels, are the same set"""
 
-                slugs = list(sorted([pair_slugify(e) for e in sorted(d.items())]))
+    def __init__(self):
+        self.ids = {}  # Content key to id
+        self.labels = {}  # Id to (labels, is_range, is_categorical)
+        self._slugs = {}  # Memo of pair_slugify()
 
-                labels_hash = hashlib.sha224(('\n'.join(slugs).encode('utf8'))).hexdigest()
+    def key(self, d):
+        """Return the content key of a label set"""
 
-                labels[labels_hash] = (d, is_range, is_categorical)
+        slugs = []
 
-                qn_to_hash[qn] = labels_hash
+        for e in d.items():
+            try:
+                slugs.append(self._slugs[e])
+            except KeyError:
+                slugs.append(self._slugs.setdefault(e, pair_slugify(e)))
 
-    hash_to_int = {hash: i for i, hash in enumerate(labels.keys())}
+        return tuple(sorted(slugs))
 
-    labels = {hash_to_int[hash]: d for hash, d in labels.items()}
-    qn_to_lid = {qn: hash_to_int[hash] for qn, hash in qn_to_hash.items()}
+    def intern(self, d, is_range, is_categorical):
+        """Return the id of a label set. If the set was seen before, it replaces the earlier one"""
 
-    return labels, qn_to_lid
+        lid = self.ids.setdefault(self.key(d), len(self.ids))
 
+        self.labels[lid] = (d, is_range, is_categorical)
 
-def create_reduced_label_sets(procd_val_labels):
-    rd = get_remap_dict(procd_val_labels)
+        return lid
 
-    labels = {}
-    qn_to_hash = {}
+
+def create_label_sets(procd_val_labels, features=None, remap=None, jobs=1):
+    """Remap the labels of categorical questions to common names, and intern the label sets. Returns
+    a dict of label set id to (labels, is_range, is_categorical), and a dict of question name to
+    label set id.
+
+    :param procd_val_labels: Output of process_value_labels()
+    :param features: LabelFeatureStore for the label clustering
+    :param remap: Output of get_remap_dict(), if it has already been computed
+    :param jobs: Number of processes for get_remap_dict()
+    """
+
+    if remap is None:
+        remap = get_remap_dict(procd_val_labels, features, jobs=jobs)
+
+    label_sets = LabelSets()
+    qn_to_lid = {}
 
     for qn, bqn, is_range, is_categorical, d in tqdm(procd_val_labels, desc='create label sets'):
 
-        if is_categorical:
+        if is_categorical and d:
 
             for k, v in list(d.items()):
-                d[k] = rd.get(qn + ':' + k, {}).get(k, v)
+                d[k] = remap.get(qn + ':' + k, {}).get(k, v)
+
+            qn_to_lid[qn] = label_sets.intern(d, is_range, is_categorical)
 
-                slugs = list(sorted([pair_slugify(e) for e in sorted(d.items())]))
+    return label_sets.labels, qn_to_lid
 
-                labels_hash = hashlib.sha224(('\n'.join(slugs).encode('utf8'))).hexdigest()
 
-                labels[labels_hash] = (d, is_range, is_categorical)
+# The reduced label sets are the same as the label sets
+create_reduced_label_sets = create_label_sets
 
-                qn_to_hash[qn] = labels_hash
 
-    hash_to_int = {hash: i for i, hash in enumerate(labels.keys())}
+# Metadata tables, and the suffixes of the CSV files they are exported to
+META_TABLES = {
+    'variable_labels': '.meta.csv',
+    'value_labels': '.labels.csv',  # All labels
+    'reduced_value_labels': '.rlabels.csv'  # Reduced labels
+}
 
-    labels = {hash_to_int[hash]: d for hash, d in labels.items()}
-    qn_to_lid = {qn: hash_to_int[hash] for qn, hash in qn_to_hash.items()}
 
-    return labels, qn_to_lid
+def infer_types(df):
+    """Return a table with the columns that hold only numbers, as numbers or strings, converted to
+    numeric columns, and empty strings converted to nulls, which are the types pd.read_csv() would
+    give the table if it were loaded from a CSV file"""
 
+    df = df.copy()
 
-def convert_cdb(cdb_file):
-    """Convert a .cdb ( data dictionary) file to CSV and add the data to the
-    HDF5 file for the survey data"""
+    for c in df.columns:
+        s = df[c].astype(object)
+        s = s.where(s.notna() & (s != ''), None)
 
-    csv_meta_file = Path(cdb_file).with_suffix('.meta.csv')
-    csv_labels_file = Path(cdb_file).with_suffix('.labels.csv')  # All labels
-    csv_reducedlabels_file = Path(cdb_file).with_suffix('.rlabels.csv')  # Reduced labels
+        try:
+            df[c] = pd.to_numeric(s)
+        except (ValueError, TypeError):
+            df[c] = s
 
-    codeb = extract_from_codebook(cdb_file)
+    return df
+
+
+def metadata_tables(cdb_file, limit=None, jobs=1):
+    """Return the metadata tables for a codebook, a dict of 'variable_labels', one row per variable,
+    'value_labels', the labels of each categorical question and 'reduced_value_labels', the
+    interned label sets. The values are as they are in the codebook, mostly strings; infer_types()
+    converts them to the table types. `limit` is passed to extract_from_codebook(), and
+    `jobs` is the number of processes for clustering labels"""
+
+    codeb = extract_from_codebook(cdb_file, limit=limit)
 
     procd_value_labels = list(process_value_labels(codeb))
 
-    wrote_files = []
+    # Before create_label_sets(), which remaps the labels in place
+    value_labels = pd.DataFrame([(qn, base_qn, k, v)
+                                 for qn, base_qn, is_range, is_categorical, d in procd_value_labels
+                                 if is_categorical for k, v in d.items()],
+                                columns='question_name base_name value label'.split())
 
-    ##
-    ##  Write full Labels file
-    with open(csv_labels_file, 'w') as fl:
-        wl = csv.writer(fl)
-        wl.writerow('question_name base_name value label'.split())
+    # Label features persist between builds, so only new labels are processed
+    features = LabelFeatureStore(Path(cdb_file).with_suffix('.features.h5'))
 
-        for i, (qn, base_qn, is_range, is_categorical, d) in enumerate(tqdm(procd_value_labels, desc='Full Labels')):
-            if is_categorical:
-                for k, v in d.items():
-                    wl.writerow([qn, base_qn, k, v])
+    labels, qn_to_lid = create_label_sets(procd_value_labels, features, jobs=jobs)
 
-        wrote_files.append(csv_labels_file)
+    features.save()
 
-    labels, qn_to_lid = create_label_sets(procd_value_labels)
+    for e in tqdm(codeb, desc='Variables'):
 
-    ##
-    ## Write meta csv, and extract labels for later.
-    with open(csv_meta_file, 'w') as fo:
+        e['labels_id'] = qn_to_lid.get(e['question_name'])
 
-        for i, e in enumerate(tqdm(codeb, desc='Variables')):
+        if e['labels_id'] is not None:
+            (_, _, e['is_categorical']) = labels[e['labels_id']]
+        else:
+            e['is_categorical'] = 0
 
-            e['labels_id'] = qn_to_lid.get(e['question_name'])
+        # No idea why some of these are missing sometimes
+        for k in ['labels_hash', 'labels', 'label_lines']:
+            e.pop(k, None)
 
-            if e['labels_id']:
-                (_, _, e['is_categorical']) = labels[e['labels_id']]
-            else:
-                e['is_categorical'] = 0
+    count(variables=len(codeb), labels=len(value_labels), label_sets=len(labels))
+
+    reduced_labels = pd.DataFrame([(lid, k, v) for lid, (d, _, _) in sorted(labels.items()) for k, v in d.items()],
+                                  columns='label_id value label'.split())
+
+    return {
+        'variable_labels': pd.DataFrame(codeb, dtype=object),
+        'value_labels': value_labels,
+        'reduced_value_labels': reduced_labels
+    }
 
-            # No idea why some of these are missing sometimes
-            for k in ['labels_hash', 'labels', 'label_lines']:
-                try:
-                    del e[k]
-                except KeyError:
-                    pass
 
-            if i == 0:
-                wv = csv.DictWriter(fo, fieldnames=e.keys())
-                wv.writeheader()
+def write_metadata(meta_file, tables):
+    """Write metadata tables from metadata_tables() to an HDF5 file, as typed tables, from which
+    h5.load_metadata() copies them into the HDF5 file for the survey data"""
+    import h5py
+    from .h5 import write_table
 
-            wv.writerow(e)
+    tmp_file = Path(meta_file).with_suffix('.tmp')
 
-        wrote_files.append(csv_meta_file)
+    with h5py.File(tmp_file, 'w') as f:
+        for name, df in tables.items():
+            write_table(f, name, infer_types(df))
 
-    ##
-    ##  Write Labels file
-    with open(csv_reducedlabels_file, 'w') as fl:
-        wl = csv.writer(fl)
-        wl.writerow('label_id value label'.split())
+    tmp_file.replace(meta_file)
 
-        for i, (lid, labels) in enumerate(tqdm(sorted(labels.items()), desc='Reduced Labels   ')):
 
-            for k, v in labels[0].items():
-                wl.writerow([lid, k, v])
+def convert_cdb(cdb_file, limit=None, jobs=1, csv=False):
+    """Convert a .cdb ( data dictionary) file to metadata tables, in a .meta.h5 file, for load_metadata() to
+    add to the HDF5 file for the survey data. If `csv` is True, also export the tables to .meta.csv,
+    .labels.csv and .rlabels.csv files. `limit` is passed to extract_from_codebook(), and
+    `jobs` is the number of processes for clustering labels. Returns the paths of the files written"""
 
-            if not labels:
-                # This happens once, for instance with BIOCHILD_BDATE.01~Y
-                wl.writerow([lid, None, None])
+    tables = metadata_tables(cdb_file, limit=limit, jobs=jobs)
 
-        wrote_files.append(csv_reducedlabels_file)
+    meta_file = Path(cdb_file).with_suffix('.meta.h5')
+
+    write_metadata(meta_file, tables)
+
+    wrote_files = [meta_file]
+
+    if csv:
+        for name, suffix in META_TABLES.items():
+            csv_file = Path(cdb_file).with_suffix(suffix)
+
+            # Line endings as the csv module writes them
+            tables[name].to_csv(csv_file, index=False, lineterminator='\r\n')
+
+            wrote_files.append(csv_file)
 
     return wrote_files
 
@@ -334,13 +613,15 @@ def convert_cdb(cdb_file):
 def main():
     import argparse
 
-    parser = argparse.ArgumentParser(description='Convert an NLSY codebook to CSV files')
+    parser = argparse.ArgumentParser(description='Convert an NLSY codebook to metadata tables')
 
     parser.add_argument('-e', '--extract', action='store_true',
                         help='Only extract the cdb file, ignoring the cached version')
 
     parser.add_argument('-c', '--convert', action='store_true', help='Create the meta and label files.')
 
+    parser.add_argument('-C', '--csv', action='store_true', help='Also export the meta and label tables to CSV files')
+
     parser.add_argument('-L', '--limit', type=int, help='set limit for number of rows processed with -e')
 
     parser.add_argument('-l', '--labels', action='store_true',
@@ -354,7 +635,7 @@ def main():
         extract_from_codebook(args.cdb_file, force=True, limit=args.limit)
 
     if args.convert:
-        convert_cdb(args.cdb_file)
+        convert_cdb(args.cdb_file, csv=args.csv)
 
 
 if __name__ == "__main__":
@@ -5,12 +5,14 @@
 Functions for processing value labels
 """
 import csv
+import re
 
 from pathlib import Path
 from tqdm import tqdm
 
 import fuzzy
-from collections import defaultdict
+import pandas as pd
+from collections import Counter, defaultdict, namedtuple
 
 dmeta = fuzzy.DMetaphone()
 
@@ -20,15 +22,18 @@ tokenizer = RegexpTokenizer(r'\w+')
 
 
 def dmeta_sub(s1, s2):
-    try:
-        p1 = sorted(dmeta(str(e))[0] for e in tokenizer.tokenize(str(s1)))
-        p2 = sorted(dmeta(str(e))[0] for e in tokenizer.tokenize(str(s2)))
-    except TypeError:
-        # print("!!! {}, {}".format(s1, s2))
-        return 100
-        # raise
+    """Return 0 if the Double Metaphone keys of the words in one string are a subset of those of the
+    other, otherwise 100"""
+
+    return _dmeta_sub(label_features(s1)[1], label_features(s2)[1])
 
-    if all(w1 in p2 for w1 in p1) or all(w2 in p1 for w2 in p2):
+
+def _dmeta_sub(k1, k2):
+    """dmeta_sub() for two sets of keys from label_features()"""
+
+    if k1 is None or k2 is None:
+        return 100
+    elif k1 <= k2 or k2 <= k1:
         return 0
     else:
         return 100
@@ -60,13 +65,157 @@ def multi_label_questions(meta_df):
             yield name
 
 
-def cluster_words(words, thresh=8):
+# Version of the label features. Change it when compute_features() changes, to invalidate stored features
+FEATURES_VERSION = 1
+
+LabelFeatures = namedtuple('LabelFeatures', 'slug tokens keys')
+
+
+def compute_features(label):
+    """Return the slug of a label, its words and the set of the Double Metaphone keys of its words. The keys
+    are None if they can't be compared, which is when some words have no key"""
+
+    import unicodedata
+
+    label = str(label)
+
+    tokens = tokenizer.tokenize(label)
+
+    try:
+        # DMetaphone only accepts ASCII
+        keys = sorted(dmeta(unicodedata.normalize('NFKD', e).encode('ascii', 'ignore').decode('ascii'))[0]
+                      for e in tokens)
+    except TypeError:
+        keys = None
+
+    return LabelFeatures(slugify(label), tuple(tokens), frozenset(keys) if keys is not None else None)
+
+
+class LabelFeatureStore(object):
+    """Features of value labels, from compute_features(), interned by the label string, so each distinct
+    label is only processed once. If the store has a path, the features are loaded from it, and save() writes
+    them back, so later builds only compute features for labels they have not seen before"""
+
+    def __init__(self, path=None):
+        self.path = Path(path) if path else None
+        self.features = {}
+        self.added = 0  # Number of features computed since the store was loaded
+
+        if self.path and self.path.exists():
+            self.load()
+
+    def __getitem__(self, label):
+        label = str(label)
+
+        try:
+            return self.features[label]
+        except KeyError:
+            f = self.features[label] = compute_features(label)
+            self.added += 1
+            return f
+
+    def __len__(self):
+        return len(self.features)
+
+    def update(self, features):
+        """Add features computed elsewhere, such as in another process"""
+        new = {k: v for k, v in features.items() if k not in self.features}
+        self.features.update(new)
+        self.added += len(new)
+
+    def load(self):
+        import h5py
+        from .h5 import read_table
+
+        with h5py.File(self.path, 'r') as f:
+            if f.attrs.get('version') != FEATURES_VERSION:
+                return
+
+            t = read_table(f, 'features')
+
+        def keyset(keys, comparable):
+            if not comparable:
+                return None
+            return frozenset(None if k == '-' else k.encode('ascii') for k in keys.split())
+
+        for label, slug, tokens, keys, comparable in zip(*(t[c] for c in t.columns)):
+            self.features[label] = LabelFeatures(slug, tuple(tokens.split()), keyset(keys, comparable))
+
+    def save(self):
+        """Write the features to the store's path, if they have changed"""
+        import h5py
+        from .h5 import write_table
+
+        if not self.path or not self.added:
+            return
+
+        labels = list(self.features)
+        features = list(self.features.values())
+
+        df = pd.DataFrame({
+            'label': labels,
+            'slug': [e.slug for e in features],
+            'tokens': [' '.join(e.tokens) for e in features],
+            'keys': [' '.join('-' if k is None else k.decode('ascii') for k in sorted(e.keys, key=str))
+                     if e.keys is not None else '' for e in features],
+            'comparable': [int(e.keys is not None) for e in features]
+        })
+
+        tmp = self.path.with_suffix('.tmp')
+
+        with h5py.File(tmp, 'w') as f:
+            write_table(f, 'features', df)
+            f.attrs['version'] = FEATURES_VERSION
+
+        tmp.replace(self.path)
+
+        self.added = 0
+
+
+# Features for labels when no other store is given
+default_features = LabelFeatureStore()
+
+
+def label_features(label, features=None):
+    """Return the slug of a label, and the set of the Double Metaphone keys of its words, from a
+    LabelFeatureStore. The keys are None if they can't be compared"""
+
+    f = (features if features is not None else default_features)[label]
+
+    return f.slug, f.keys
+
+
+class _Cluster(object):
+    """A cluster of words for cluster_words(), with counts of the distinct slugs and the distinct
+    key sets of its members, so comparing a word to the cluster is proportional to the number of
+    distinct labels in it, rather than the number of members"""
+
+    def __init__(self):
+        self.members = set()
+        self.slugs = Counter()
+        self.keysets = set()
+
+    def add(self, word, slug, keys):
+        if word not in self.members:
+            self.members.add(word)
+            self.slugs[slug] += 1
+            if keys is not None:
+                self.keysets.add(keys)
+
+
+def cluster_words(words, thresh=8, features=None):
     """Return clusters of words, where word are added to clusters where
     the word has an average levenshtein of less than a threshold
 
     Each word is actally a tuple, with the word being the first item, and any other
     data in subsequent items
 
+    A word is added to the first cluster where the average Levenshtein distance between the slugs of
+    the word and of the members is less than `thresh`, or where dmeta_sub() with any member is less than
+    `thresh`. The features of each label are computed once, in the LabelFeatureStore `features`, and the
+    distance to a cluster is only computed when its lower bound, the difference in slug lengths, is under
+    the threshold.
+
     """
 
     import stringdist
@@ -74,25 +223,35 @@ def cluster_words(words, thresh=8):
     clusters = []
 
     for w1 in words:
+        slug, keys = label_features(w1[0], features)
+
+        distances = {}  # Distances from this word's slug to slugs in the clusters
+
+        def lev(s):
+            if s not in distances:
+                distances[s] = stringdist.levenshtein(slug, s)
+            return distances[s]
 
-        placed = False
         for cluster in clusters:
-            # Average dist to all words in the cluster
-            ad = sum(stringdist.levenshtein(slugify(w1[0]), slugify(w2[0])) for w2 in cluster) / float(len(cluster))
-            if ad < thresh:
-                cluster.add(w1)
-                placed = True
-                break
+            n = float(len(cluster.members))
 
-            elif any(dmeta_sub(w1[0], w2[0]) < thresh for w2 in cluster):
-                cluster.add(w1)
-                placed = True
+            if sum(c * abs(len(slug) - len(s)) for s, c in cluster.slugs.items()) / n < thresh:
+                # Average dist to all words in the cluster
+                if sum(c * lev(s) for s, c in cluster.slugs.items()) / n < thresh:
+                    break
+
+            if thresh > 100:
+                break
+            elif thresh > 0 and keys is not None and any(keys <= k or k <= keys for k in cluster.keysets):
                 break
 
-        if not placed:
-            clusters.append(set([w1]))
+        else:
+            cluster = _Cluster()
+            clusters.append(cluster)
+
+        cluster.add(w1, slug, keys)
 
-    return clusters
+    return [cluster.members for cluster in clusters]
 
 
 def get_clusters(qn, meta_df, label_df):
@@ -181,9 +340,105 @@ def process_value_labels(v):
         yield [var['question_name'], var['base_qn'], is_range, is_categorical, d]
 
 
-def generate_remap_rows(procd_val_labels):
-    """Yield rows that map value labels to names that are more common across questions"""
+def _word_key(e):
+    """Sort key for the (label, question name) words of a cluster, so clusters don't
+    depend on the order of a set"""
+    return str(e[0]), e[1]
+
+
+def _remap_group(label_sets, features=None):
+    """Return the remap rows for the label sets of one base question, a list of
+    (label set, question name)"""
+
+    rows = []
 
+    value_labels = defaultdict(set)
+
+    for ls, qn in label_sets:  # Group labels by value
+        for k, v in ls.items():
+            value_labels[k].add((v, qn))
+
+    # For each value, cluster all of the labels.
+    for k, v in value_labels.items():
+        clusters = cluster_words(sorted(v, key=_word_key), features=features)
+        for cn, cluster in enumerate(clusters):
+            cluster = sorted(cluster, key=_word_key)
+
+            # For each cluster, find the shortest label,
+            # then emit re-mappings for all of the other ones
+            try:
+                shortest = min((e[0] for e in cluster if e[0].strip()), key=len).strip()
+            except ValueError:
+                shortest = cluster[0][0].strip()
+
+            for label, qn in cluster:
+                if label != shortest and label and shortest:
+                    rows.append((qn, k, cn, label, shortest))
+
+    return rows
+
+
+def _remap_groups(groups, features):
+    """Return the remap rows for each of a list of base question groups, and the features that
+    were computed for them. Runs in a worker process, with `features` the subset of the
+    parent's features for the labels in the groups"""
+
+    store = LabelFeatureStore()
+    store.features.update(features)
+
+    rows = [_remap_group(label_sets, store) for label_sets in groups]
+
+    return rows, {k: v for k, v in store.features.items() if k not in features}
+
+
+def _remap_parallel(groups, features, jobs):
+    """Cluster the base question groups in a pool of `jobs` processes, and return the remap rows
+    for each group, in the same order as the groups"""
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    # Contiguous batches of about the same number of labels, several per process
+    # so a few large questions don't leave the other processes idle
+    sizes = [sum(len(ls) for ls, _ in label_sets) for label_sets in groups]
+    batch_size = max(1, sum(sizes) // (jobs * 4))
+
+    batches = [[]]
+    n = 0
+    for i, size in enumerate(sizes):
+        if n >= batch_size:
+            batches.append([])
+            n = 0
+        batches[-1].append(i)
+        n += size
+
+    results = [None] * len(groups)
+
+    with ProcessPoolExecutor(jobs) as pool:
+        futures = {}
+
+        for batch in batches:
+            batch_groups = [groups[i] for i in batch]
+            labels = {str(v) for label_sets in batch_groups for ls, _ in label_sets for v in ls.values()}
+            known = {k: features.features[k] for k in labels if k in features.features}
+
+            futures[pool.submit(_remap_groups, batch_groups, known)] = batch
+
+        for future in tqdm(as_completed(futures), total=len(futures), desc='find clusters'):
+            rows, new_features = future.result()
+
+            for i, group_rows in zip(futures[future], rows):
+                results[i] = group_rows
+
+            features.update(new_features)
+
+    return results
+
+
+def generate_remap_rows(procd_val_labels, features=None, jobs=1):
+    """Yield rows that map value labels to names that are more common across questions.
+
+    The label sets of each base question are clustered independently, so with `jobs` greater
+    than 1 the base questions are clustered in a pool of that many processes. The rows are the
+    same, and in the same order, for any number of jobs"""
 
     qn_labels = defaultdict(list)
 
@@ -191,35 +446,23 @@ def generate_remap_rows(procd_val_labels):
     for qn, bqn, _, _, d in procd_val_labels:
         qn_labels[bqn].append((d, qn))
 
-    for bqn, label_sets in tqdm(qn_labels.items(), desc='find clusters'):  # For each question name.
-
-        value_labels = defaultdict(set)
+    groups = list(qn_labels.values())
 
-        for ls, qn in label_sets:  # Group labels by value
-            for k, v in ls.items():
-                value_labels[k].add((v, qn))
-
-        # For each value, cluster all of the labels.
-        for k, v in value_labels.items():
-            clusters = cluster_words(v)
-            for cn, cluster in enumerate(clusters):
-                # For each cluster, find the shortest label,
-                # then emit re-mappings for all of the other ones
-                try:
-                    shortest = min((e[0] for e in cluster if e[0].strip()), key=len).strip()
-                except ValueError:
-                    shortest = list(cluster)[0][0].strip()
+    if jobs > 1 and len(groups) > 1:
+        features = features if features is not None else default_features
 
-                for label, qn in cluster:
-                    if label != shortest and label and shortest:
-                        yield (qn, k, cn, label, shortest)
+        for rows in _remap_parallel(groups, features, jobs):
+            yield from rows
+    else:
+        for label_sets in tqdm(groups, desc='find clusters'):  # For each question name.
+            yield from _remap_group(label_sets, features)
 
 
-def get_remap_dict(procd_val_labels):
+def get_remap_dict(procd_val_labels, features=None, jobs=1):
 
     rd = defaultdict(dict)
 
-    for qn, k, cn, label, shortest in generate_remap_rows(procd_val_labels):
+    for qn, k, cn, label, shortest in generate_remap_rows(procd_val_labels, features, jobs):
         rd[qn + ':' + str(k)][label] = shortest
 
     return rd
@@ -234,109 +477,139 @@ def write_remap_file(cdb_file):
         w.writerows(generate_remap_rows(cdb_file))
 
 
-def join_label_lines(lines):
-    """Join lines that don't start with a count to the previous line"""
-    import re
+# Patterns for normalizing label lines. The three 'Other - Recoded to' patterns all have a '-', and
+# the other patterns a literal character, which is checked before the pattern is run
+_LEADING_SPACE = re.compile(r'^\s\s\s\s')
+_COUNT_START = re.compile(r'^\s*\d+')
+_RECODED = re.compile(r'Other\s*-\s*Recoded to', re.IGNORECASE)
+_RECOED = re.compile(r'Other\s*-\s*Recoed to', re.IGNORECASE)
+_ADDED = re.compile(r'Added in -', re.IGNORECASE)
+_GO_TO = re.compile(r'\(\s*Go To [^\)]+\s*\)')
+_NUMBER_DOT = re.compile(r'\d+\.')
+_LEADING_NUMBER = re.compile(r'^(\d+)\s+')
+_LONG_LABEL = re.compile(r'\d+\s+([^:]{15,}):')
+_NUMBER_REST = re.compile(r'(\d+)\s+(.*)')
+_RANGE = re.compile(r'^\d+ TO \d+$')
+_NUMBER_SPACE = re.compile(r'(\d+)\s*')
 
-    def _joined_lines(lines):
 
-        continue_line = None
-        for line in reversed(lines):
+def _join_lines(lines):
+    """Return a list of the lines that start with a count, with the line after each joined to it,
+    if it does not start with a count"""
 
-            line = re.sub('^\s\s\s\s', '', line)
+    joined = []
 
-            if not re.match('^\s*\d+', line):
-                continue_line = line
-                continue
+    continue_line = None
+    for line in reversed(lines):
 
-            if 'or Advanced Biology' in line:
-                # Line should be matched by clause above, but it isn't because it starts with a number
-                print('!!!', line)
-                continue_line = line
-                continue
+        line = _LEADING_SPACE.sub('', line)
 
-            if continue_line:
-                line = line + ' ' + (continue_line.strip())
-                continue_line = None
+        if not _COUNT_START.match(line):
+            continue_line = line
+            continue
 
-            yield line.strip()
+        if 'or Advanced Biology' in line:
+            # Line should be matched by clause above, but it isn't because it starts with a number
+            print('!!!', line)
+            continue_line = line
+            continue
 
-    return reversed(list(_joined_lines(lines)))
+        if continue_line:
+            line = line + ' ' + (continue_line.strip())
+            continue_line = None
 
+        joined.append(line.strip())
+
+    joined.reverse()
+
+    return joined
 
-def markup_label_lines(lines):
-    """Add a pipe character between parts of the line"""
-    import re
 
-    def clean(lines):
-        for line in lines:
-            line = re.sub('Other\s*-\s*Recoded to', '', line, flags=re.IGNORECASE)
-            line = re.sub('Other\s*-\s*Recoed to', '', line, flags=re.IGNORECASE)
-            line = re.sub('Added in -', '', line, flags=re.IGNORECASE)
-            line = re.sub('0 FI:', '0: FI', line)
-            line = re.sub(r'\(\s*Go To [^\)]+\s*\)', '', line).strip().replace('\t', '|')
-            line = re.sub('\d+\.', '', line)
+def _clean_line(line):
+    """Remove recoding notes, skip instructions and numbering from a label line"""
 
-            yield line
+    if '-' in line:
+        line = _RECODED.sub('', line)
+        line = _RECOED.sub('', line)
+        line = _ADDED.sub('', line)
 
-    def mark_splits(lines):
+    line = line.replace('0 FI:', '0: FI')
 
-        # Using the replace with | technique because
-        # its easy to debug
-        for line in lines:
+    if '(' in line:
+        line = _GO_TO.sub('', line)
 
-            # Remove the count number
-            line = re.sub('^(\d+)\s+', '', line)
+    line = line.strip().replace('\t', '|')
 
-            if re.search('\d+\s+([^:]{15,}):', line):
-                line = re.sub('(\d+)\s+(.*)',r'\1: \2', line)
-                mark = True
+    if '.' in line:
+        line = _NUMBER_DOT.sub('', line)
 
-            line = line.replace(':', '|', 1)
+    return line
 
-            # Lines with match position of colons, like:
-            #
 
+def _mark_line(line):
+    """Add a pipe character between the value and the label"""
 
-            if not '|' in line:
-                if re.match('^\d+ TO \d+$', line.strip()):
-                    line = line + '|'  # Its a range
-                else:
-                    # It just just missing the ':'
-                    line = re.sub('(\d+)\s*', r'\1|', line, count=1)
+    # Using the replace with | technique because
+    # its easy to debug
 
+    # Remove the count number
+    line = _LEADING_NUMBER.sub('', line)
 
-            yield line
+    if _LONG_LABEL.search(line):
+        line = _NUMBER_REST.sub(r'\1: \2', line)
 
-    return mark_splits(clean(lines))
+    line = line.replace(':', '|', 1)
+
+    if '|' not in line:
+        if _RANGE.match(line.strip()):
+            line = line + '|'  # Its a range
+        else:
+            # It just just missing the ':'
+            line = _NUMBER_SPACE.sub(r'\1|', line, count=1)
+
+    return line
+
+
+def _split_line(line):
+    """Break a marked up line into a (value, label) tuple"""
+
+    parts = line.split('|')
+
+    if len(parts) == 2:
+        k = parts[0].strip()
+        v = parts[1].strip()
+    else:
+        # Some entries have a key and no value
+        k = parts[0].strip()
+        v = None
+
+    k = k.replace(' TO ', '-')
+
+    if v:
+        v = v.replace('{}.'.format(k), '').strip()
+
+        # There are still a few labels that have numbers at the start
+        # Buy only remove 3 or fewer, because a year at the start is valid, such as
+        # int YCOC-003C
+        v = _LEADING_NUMBER.sub('', v).strip()
+        v = v.capitalize()
+
+    return k, v
+
+
+def join_label_lines(lines):
+    """Join lines that don't start with a count to the previous line"""
+    return _join_lines(lines)
+
+
+def markup_label_lines(lines):
+    """Add a pipe character between parts of the line"""
+    return (_mark_line(_clean_line(line)) for line in lines)
 
 
 def split_lines(lines):
     """Break a line into parts and yield tuples"""
-    import re
-
-    for line in lines:
-        try:
-            k, v = line.split('|')
-            k = k.strip()
-            v = v.strip()
-        except ValueError:
-            # Some entries have a key and no value
-            k = (line.split('|')[0]).strip()
-            v = None
-
-        k = k.replace(' TO ', '-')
-
-        if v:
-            v = v.replace('{}.'.format(k), '').strip()
-
-            # There are still a few labels that have numbers at the start
-            # Buy only remove 3 or fewer, because a year at the start is valid, such as
-            # int YCOC-003C
-            v = re.sub('^(\d+)\s+', '', v).strip()
-            v = v.capitalize()
-
-        yield (k, v)
+    return (_split_line(line) for line in lines)
 
 
 def analyze_entries(qn, entries):
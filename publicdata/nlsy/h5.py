@@ -12,62 +12,450 @@ from pathlib import Path
 import pandas as pd
 import numpy as np
 from tqdm import tqdm
-from math import ceil
-from itertools import islice
 
-def convert_nlsy(dat_file, header_file, hdf5_file):
-    """Convert an nlsy file data file to HDF5"""
+from .archive import open_file
+from .instrument import count
+
+def count_rows(dat_file, block_size=2 ** 24):
+    """Count the rows in a .dat file, the lines that are not blank, without parsing them"""
+
+    nrows = 0
+    rest = b''
+
+    with open_file(dat_file, 'rb') as f:
+        while True:
+            b = f.read(block_size)
+            if not b:
+                break
+
+            lines = (rest + b).split(b'\n')
+            rest = lines.pop()  # Incomplete, or the last line
+
+            nrows += sum(1 for line in lines if line.strip())
+
+    if rest.strip():
+        nrows += 1  # Last line has no line ending
+
+    return nrows
+
+
+def iter_row_blocks(dat_file, ncols, block_size=2 ** 24):
+    """Yield 2D int32 arrays of rows parsed from a .dat file, reading roughly `block_size`
+    bytes of text per block. Blank lines are skipped, and values that are not integers, or rows
+    that don't have `ncols` values, raise ValueError"""
+
+    with open_file(dat_file) as f:
+        while True:
+            lines = f.readlines(block_size)
+            if not lines:
+                break
+
+            lines = [line for line in lines if line.strip()]
+            if not lines:
+                continue
+
+            a = np.loadtxt(lines, dtype=np.int32, ndmin=2)
+
+            if a.shape[1] != ncols:
+                raise ValueError(f"Rows in {dat_file} have {a.shape[1]} values, but there are {ncols} columns")
+
+            yield a
+
+
+def chunk_shape(layout, nrows, ncols, itemsize=4, chunk_bytes=2 ** 16):
+    """Return the chunk shape for the survey dataset
+
+    'row' lets h5py pick the chunk shape. 'column' makes each chunk span all of the rows
+    and as many columns as fit in about `chunk_bytes`, so reading a column decompresses
+    only the chunks that hold it.
+    """
+
+    if layout == 'row':
+        return True
+    elif layout == 'column':
+        cols = chunk_bytes // (max(nrows, 1) * itemsize)
+        return (max(nrows, 1), max(1, min(ncols, cols)))
+    else:
+        raise ValueError(f"Unknown layout '{layout}'; must be 'row' or 'column'")
+
+
+def chunk_cache_size(node, columns=256, min_bytes=2 ** 20, max_bytes=2 ** 26):
+    """Return the raw data chunk cache settings ( as h5py.File() kwargs ) that hold
+    the chunks for `columns` columns of a dataset, across all rows. If `node` is a group
+    of datasets, the settings are for the dataset that needs the largest cache"""
+
+    if isinstance(node, h5py.Group):
+        settings = [chunk_cache_size(ds, columns, min_bytes, max_bytes) for ds in node.values()
+                    if isinstance(ds, h5py.Dataset) and ds.ndim == 2]
+        return max(settings, key=lambda e: e.get('rdcc_nbytes', 0), default={})
+
+    ds = node
+
+    if ds.chunks is None:
+        return {}
+
+    nrows, ncols = ds.shape
+    chunk_rows, chunk_cols = ds.chunks
+
+    chunk_bytes = chunk_rows * chunk_cols * ds.dtype.itemsize
+
+    nchunks = (-(-nrows // chunk_rows)) * (-(-min(columns, ncols) // chunk_cols))
+
+    nbytes = min(max_bytes, max(min_bytes, nchunks * chunk_bytes))
+
+    return {
+        'rdcc_nbytes': nbytes,
+        'rdcc_nslots': (100 * max(1, nbytes // chunk_bytes)) | 1,
+        'rdcc_w0': 1.0 if ds.attrs.get('layout') == 'column' else 0.75
+    }
+
+
+def column_itemsizes(lo, hi):
+    """Return the itemsize of the smallest signed integer type that holds each column,
+    given arrays of the column minimums and maximums"""
+
+    itemsizes = np.full(len(lo), 4, dtype=np.uint8)
+
+    for dtype in (np.int16, np.int8):
+        info = np.iinfo(dtype)
+        itemsizes[(lo >= info.min) & (hi <= info.max)] = info.dtype.itemsize
+
+    return itemsizes
+
+
+def stage_rows(dat_file, ncols, nrows, stage_file, block_size=2 ** 24):
+    """Parse the .dat file into an uncompressed memmap. Returns the memmap and arrays
+    of the minimum and maximum of each column"""
+
+    stage = np.memmap(stage_file, dtype=np.int32, mode='w+', shape=(nrows, ncols))
+
+    lo = np.zeros(ncols, dtype=np.int32)
+    hi = np.zeros(ncols, dtype=np.int32)
+
+    with tqdm(total=nrows, ncols=80, desc='Load HDF5') as progress:
+        row_n = 0
+        for a in iter_row_blocks(dat_file, ncols, block_size):
+            stage[row_n:row_n + len(a), :] = a
+
+            if row_n == 0:
+                lo, hi = a.min(axis=0), a.max(axis=0)
+            else:
+                np.minimum(lo, a.min(axis=0), out=lo)
+                np.maximum(hi, a.max(axis=0), out=hi)
+
+            row_n += len(a)
+            progress.update(len(a))
+
+    if row_n != nrows:
+        raise ValueError(f"Expected {nrows} rows in {dat_file}, but parsed {row_n}")
+
+    return stage, lo, hi
+
+
+def write_slabs(stage, targets, layout, block_size=2 ** 24):
+    """Copy the staged rows into the HDF5 datasets. `targets` is a list of (dataset, col_nos)
+    pairs. Row layouts are written in slabs of rows and column layouts in slabs of whole chunks
+    of columns, each about block_size bytes"""
+
+    nrows = len(stage)
+
+    if layout == 'row':
+        slab_rows = max(1, block_size // (max(stage.shape[1], 1) * 4))
+
+        for row_n in tqdm(range(0, nrows, slab_rows), ncols=80, desc='Write rows'):
+            slab = np.asarray(stage[row_n:row_n + slab_rows])
+            for ds, col_nos in targets:
+                ds[row_n:row_n + len(slab), :] = slab[:, col_nos].astype(ds.dtype)
+
+    else:
+        with tqdm(total=sum(len(col_nos) for _, col_nos in targets), ncols=80, desc='Write columns') as progress:
+            for ds, col_nos in targets:
+                chunk_cols = ds.chunks[1]
+                slab_cols = max(1, block_size // (max(nrows, 1) * 4 * chunk_cols)) * chunk_cols
+
+                for i in range(0, len(col_nos), slab_cols):
+                    ds[:, i:i + slab_cols] = stage[:, col_nos[i:i + slab_cols]].astype(ds.dtype)
+                    progress.update(len(col_nos[i:i + slab_cols]))
+
+
+def convert_nlsy(dat_file, header_file, hdf5_file, layout='row', downcast=True, block_size=2 ** 24):
+    """Convert an nlsy file data file to HDF5
+
+    The .dat file is streamed in blocks of about `block_size` bytes, and each block is
+    parsed with numpy and written to the dataset as a single slab.
+
+    With `layout='column'` the dataset is chunked by columns, which is much faster for
+    reading a few columns for all respondents, as NLSY.get_dataframe() does. Because each
+    block of rows would touch every chunk, the rows are first staged in an uncompressed
+    temporary file, then written to the dataset in column slabs.
+
+    With `downcast=True`, each column is stored in the smallest integer type that holds its
+    values. The survey data is then a group, with one dataset per type ( 'int8', 'int16', 'int32' ),
+    and 'col_dtype' and 'col_index' datasets that give the itemsize of each column's type and
+    its position in the dataset for that type.
+    """
+
+    from tempfile import TemporaryDirectory
 
     base = Path(dat_file).stem
 
-    nrows = 8983
-    chunk_size = 250
-    nchunks = ceil(nrows / chunk_size)
+    with open_file(header_file) as f:
+        ncols = len([c.strip() for c in f.readlines()])
+
+    nrows = count_rows(dat_file)
+
+    count(rows=nrows, variables=ncols)
+
+    with h5py.File(hdf5_file, "w") as h5f, TemporaryDirectory(dir=Path(hdf5_file).parent) as td:
+
+        if layout == 'row' and not downcast:
+            # Nothing to compute before writing, so stream directly into the dataset
+            dset = h5f.create_dataset(f'{base}', (nrows, ncols), dtype=np.int32,
+                                      chunks=chunk_shape(layout, nrows, ncols), compression="gzip")
+            dset.attrs['layout'] = layout
+
+            with tqdm(total=nrows, ncols=80, desc='Load HDF5') as progress:
+                row_n = 0
+                for a in iter_row_blocks(dat_file, ncols, block_size):
+                    dset[row_n:row_n + len(a), :] = a
+                    row_n += len(a)
+                    progress.update(len(a))
+
+            if row_n != nrows:
+                raise ValueError(f"Expected {nrows} rows in {dat_file}, but parsed {row_n}")
 
-    def header_row():
-        # Yield the header
-        with open(header_file) as f:
-            return [c.strip() for c in f.readlines()]
+            return
 
-    def yield_rows():
+        stage, lo, hi = stage_rows(dat_file, ncols, nrows, Path(td).joinpath('stage.dat'), block_size)
 
-        with open(dat_file) as f:
-            for i, line in enumerate(islice(f.readlines(), nrows)):
-                yield line.rstrip().split(' ')
+        if downcast:
+            itemsizes = column_itemsizes(lo, hi)
+            col_index = np.zeros(ncols, dtype=np.int32)
 
-    ncols = len(header_row())
+            grp = h5f.create_group(base)
+            grp.attrs['layout'] = layout
+            grp.attrs['shape'] = (nrows, ncols)
 
-    chunkn = 0
-    with h5py.File(hdf5_file, "w") as h5f:
+            targets = []
+            for itemsize in sorted(set(int(e) for e in itemsizes)):
+                col_nos = np.flatnonzero(itemsizes == itemsize)
+                col_index[col_nos] = np.arange(len(col_nos))
 
-        dset = h5f.create_dataset(f'{base}', (chunk_size * nchunks, ncols), dtype=np.int32, chunks=True,
-                                  compression="gzip")
+                dtype = np.dtype(f'int{itemsize * 8}')
+                ds = grp.create_dataset(dtype.name, (nrows, len(col_nos)), dtype=dtype,
+                                        chunks=chunk_shape(layout, nrows, len(col_nos), itemsize),
+                                        compression="gzip")
+                ds.attrs['layout'] = layout
+                targets.append((ds, col_nos))
 
-        a = np.zeros((chunk_size, ncols), dtype=np.int32)
+            grp.create_dataset('col_dtype', data=itemsizes)
+            grp.create_dataset('col_index', data=col_index)
 
-        for row_n, row in enumerate(tqdm(yield_rows(), total=nrows, ncols=80, desc='Load HDF5')):
+        else:
+            dset = h5f.create_dataset(f'{base}', (nrows, ncols), dtype=np.int32,
+                                      chunks=chunk_shape(layout, nrows, ncols), compression="gzip")
+            dset.attrs['layout'] = layout
+            targets = [(dset, np.arange(ncols))]
+
+        write_slabs(stage, targets, layout, block_size)
+
+        del stage
+
+
+def convert_mmap(hdf5_file, mmap_dir=None, block_size=2 ** 24):
+    """Write the survey matrix of an HDF5 file to a directory of uncompressed, column-major
+    ( Fortran order ) .npy files, one per integer type, for memory mapped reads with
+    NLSY(..., backend='mmap'). The directory also has col_dtype.npy and col_index.npy, with the
+    same meaning as the datasets in the HDF5 survey group"""
+    from .store import Hdf5Store
+
+    hdf5_file = Path(hdf5_file)
+    base = hdf5_file.stem
+
+    mmap_dir = Path(mmap_dir) if mmap_dir else hdf5_file.with_suffix('.mmap')
+    mmap_dir.mkdir(parents=True, exist_ok=True)
+
+    with h5py.File(hdf5_file, 'r') as f:
+        store = Hdf5Store(f, base)
+
+        count(rows=store.shape[0], variables=store.shape[1])
+
+        np.save(mmap_dir.joinpath('col_dtype.npy'), store.col_dtype)
+        np.save(mmap_dir.joinpath('col_index.npy'), store.col_index)
+
+        for itemsize, ds in store.datasets.items():
+            nrows, ncols = ds.shape
+
+            mm = np.lib.format.open_memmap(mmap_dir.joinpath(f'{ds.dtype.name}.npy'), mode='w+',
+                                           dtype=ds.dtype, shape=ds.shape, fortran_order=True)
+
+            # Read in slabs that follow the chunk layout
+            if ds.attrs.get('layout') == 'column':
+                step = max(1, block_size // (max(nrows, 1) * itemsize))
+                for col_n in tqdm(range(0, ncols, step), ncols=80, desc=f'Write {ds.dtype.name}'):
+                    mm[:, col_n:col_n + step] = ds[:, col_n:col_n + step]
+            else:
+                step = max(1, block_size // (max(ncols, 1) * itemsize))
+                for row_n in tqdm(range(0, nrows, step), ncols=80, desc=f'Write {ds.dtype.name}'):
+                    mm[row_n:row_n + step, :] = ds[row_n:row_n + step, :]
+
+            mm.flush()
+            del mm
+
+    return mmap_dir
+
+
+def _int_dtype(lo, hi, reserve=0):
+    """Return the smallest signed integer type that holds lo to hi, with `reserve`
+    values below lo left over"""
+
+    for dtype in (np.int8, np.int16, np.int32, np.int64):
+        info = np.iinfo(dtype)
+        if lo - reserve >= info.min and hi <= info.max:
+            return dtype
+
+    return np.int64
+
+
+def write_table(f, name, df):
+    """Write a dataframe as a group of typed datasets, one per column
+
+    Integer columns, including float columns that hold only integers and nulls, are stored
+    in the smallest integer type, with nulls stored as the 'na_value' attribute. Other
+    numeric columns are float64. All other columns are stored as strings, dictionary encoded
+    as int32 codes into a '_categories/<column>' string dataset, with -1 for nulls.
+    """
+
+    if name in f:
+        del f[name]
+
+    g = f.create_group(name)
+    g.attrs['columns'] = [str(c) for c in df.columns]
+
+    cats = g.create_group('_categories')
+
+    kw = dict(compression='gzip') if len(df) else {}
+
+    for c in df.columns:
+        s = df[c]
+        na = s.isna().to_numpy()
+
+        if pd.api.types.is_numeric_dtype(s) or pd.api.types.is_bool_dtype(s):
+            valid = s[~na].to_numpy(dtype=np.float64)
+
+            if (np.mod(valid, 1) == 0).all():
+                lo, hi = (valid.min(), valid.max()) if len(valid) else (0, 0)
+                dtype = _int_dtype(lo, hi, reserve=int(na.any()))
+
+                data = np.zeros(len(s), dtype=dtype)
+                data[~na] = valid
+                data[na] = np.iinfo(dtype).min
+
+                ds = g.create_dataset(str(c), data=data, **kw)
+                ds.attrs['kind'] = 'int'
 
-            a[row_n % chunk_size, :] = [int(e) for e in row]
+                if na.any():
+                    ds.attrs['na_value'] = np.iinfo(dtype).min
+
+            else:
+                ds = g.create_dataset(str(c), data=s.to_numpy(dtype=np.float64, na_value=np.nan), **kw)
+                ds.attrs['kind'] = 'float'
+
+        else:
+            values = s.astype(object).where(~na, None)
+            values[~na] = values[~na].map(str)
+
+            codes, uniques = pd.factorize(values)
+
+            ds = g.create_dataset(str(c), data=codes.astype(np.int32), **kw)
+            ds.attrs['kind'] = 'str'
+
+            cats.create_dataset(str(c), data=[str(e) for e in uniques], dtype=h5py.string_dtype())
+
+    return g
+
+
+def read_table(f, name, columns=None, categorical=False):
+    """Read a table written by write_table() to a dataframe. Integer columns with nulls are returned
+    as float64 with NaN, and string columns as objects, or as pandas categoricals if `categorical` is True"""
+
+    g = f[name]
+
+    if columns is None:
+        columns = list(g.attrs['columns'])
+
+    data = {}
+
+    for c in columns:
+        ds = g[c]
+        kind = ds.attrs['kind']
+
+        if kind == 'str':
+            codes = ds[:]
+            cats = g['_categories'][c].asstr()[:]
+
+            if categorical:
+                data[c] = pd.Categorical.from_codes(codes, cats)
+            else:
+                # Code -1 selects the None at the end
+                data[c] = np.append(cats.astype(object), [None])[codes]
 
-            if (row_n + 1) % chunk_size == 0:
-                dset[chunkn * chunk_size:(chunkn + 1) * chunk_size, :] = a[:, :]
-                a = np.zeros((chunk_size, ncols), dtype=np.int32)
-                chunkn += 1
         else:
-            dset[chunkn * chunk_size:(chunkn + 1) * chunk_size, :] = a[:, :]
+            values = ds[:]
 
-        dset.resize((nrows, ncols))
+            if 'na_value' in ds.attrs:
+                na = values == ds.attrs['na_value']
+                if na.any():
+                    values = values.astype(np.float64)
+                    values[na] = np.nan
 
+            data[c] = values
 
-def load_metadata(dat_file ):
-    """Load metadata into the HDF file"""
+    return pd.DataFrame(data, columns=columns)
+
+
+def write_column_index(f, base):
+    """Write a store.ColumnIndex for the <base>_variable_labels table, as the datasets 'names', the sorted
+    variable names, variable names without the dot and question names, and 'col_no', in a <base>_column_index
+    group, so NLSY can look up names without loading the table"""
+    from .store import INDEX_COLUMNS, ColumnIndex
+
+    index = ColumnIndex.from_table(read_table(f, base + '_variable_labels', ['col_no'] + list(INDEX_COLUMNS)))
+
+    name = base + '_column_index'
+
+    if name in f:
+        del f[name]
+
+    g = f.create_group(name)
+
+    kw = dict(compression='gzip') if len(index) else {}
+
+    g.create_dataset('names', data=index.names, **kw)
+    g.create_dataset('col_no', data=index.col_nos, **kw)
+
+    return g
+
+
+def load_metadata(dat_file, header_file=None):
+    """Load metadata into the HDF file
+
+    The metadata tables are stored with write_table(), so they load with their types, without
+    parsing strings. The variable labels are stored as <base>_variable_labels, the value labels
+    as <base>_value_labels and the reduced value labels as <base>_reduced_value_labels.
+
+    The tables are copied from the .meta.h5 file written by cdb.convert_cdb(), or, for
+    files converted before there was one, loaded from the .meta.csv, .labels.csv and .rlabels.csv files.
+    The names of the columns are indexed with write_column_index().
+    """
 
     hdf5_file = Path(dat_file).with_suffix('.h5')
 
+    meta_file = Path(dat_file).with_suffix('.meta.h5')
     csv_meta_file = Path(dat_file).with_suffix('.meta.csv')
     csv_labels_file = Path(dat_file).with_suffix('.labels.csv') # All labels
     csv_reducedlabels_file = Path(dat_file).with_suffix('.rlabels.csv')  # Reduced labels
-    header_file = Path(dat_file).with_suffix('.NLSY97')
+    header_file = header_file or Path(dat_file).with_suffix('.NLSY97')
 
     with h5py.File(hdf5_file, 'r+') as f:
 
@@ -80,36 +468,46 @@ def load_metadata(dat_file ):
 
         # Value and Variable labels
 
-        for dsn, fn in (('value_labels', csv_labels_file),
-                        ('reduced_value_labels', csv_reducedlabels_file),
-                        ('variable_labels', csv_meta_file)):
+        mf = h5py.File(meta_file, 'r') if meta_file.exists() else None
+
+        try:
+            for table, fn in (('value_labels', csv_labels_file),
+                              ('reduced_value_labels', csv_reducedlabels_file),
+                              ('variable_labels', csv_meta_file)):
 
-            dsn = base + '_' + dsn
+                dsn = base + '_' + table
 
-            values = pd.read_csv(fn, low_memory=False)
+                if mf is not None:
+                    if dsn in f:
+                        del f[dsn]
 
-            if dsn in f:
-                del f[dsn]
+                    # Already typed, so the datasets are copied without decoding them
+                    mf.copy(mf[table], f, name=dsn)
+                else:
+                    values = pd.read_csv(fn, low_memory=False)
 
-            f.create_dataset(dsn, values.shape, dtype=h5py.special_dtype(vlen=str), chunks=True, compression="gzip",
-                             data=values)
+                    write_table(f, dsn, values)
 
-            if dsn+'_headers' in f:
-                del f[dsn+'_headers']
+                # Headers for the older, all-string version of the table
+                if dsn+'_headers' in f:
+                    del f[dsn+'_headers']
+        finally:
+            if mf is not None:
+                mf.close()
 
-            f.create_dataset(dsn+'_headers',  (len(values.columns),), dtype=h5py.special_dtype(vlen=str), chunks=True,
-                             compression="gzip",
-                             data=values.columns)
+        write_column_index(f, base)
 
+        with open_file(header_file) as hf:
+            headers_df = pd.read_csv(hf, header=None)
 
-        headers_df = pd.read_csv(header_file, header=None)
+        count(variables=len(headers_df))
 
         if base + '_headers' in f:
             del f[base + '_headers']
 
         f.create_dataset(base + '_headers', (len(headers_df),), dtype=h5py.special_dtype(vlen=str), chunks=True,
                          compression="gzip",
-                         data=headers_df)
+                         data=[str(e) for e in headers_df[0]])
 
 def main():
     import argparse
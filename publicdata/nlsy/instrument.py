@@ -0,0 +1,104 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# MIT License, included in this distribution as LICENSE
+
+"""
+Measure the resources a build stage uses: wall and CPU time, peak resident memory, bytes read
+and written, and counts of the rows, variables and labels that the stage functions report
+with count().
+
+    result, metrics = measure(convert_cdb, cdb_file)
+
+CPU time includes child processes, such as the pools that parse codebooks and cluster labels,
+once they have exited. Bytes read and written are for the process itself, from /proc/self/io,
+and peak memory is reset at the start of each measurement where Linux allows it, otherwise
+it is the peak for the life of the process. Measurements that the platform doesn't provide
+are None.
+"""
+
+import os
+import sys
+from collections import Counter
+from time import perf_counter
+
+# Counts reported by the function being measured
+_counts = Counter()
+
+
+def count(**counts):
+    """Add to the counts of the things, such as rows and variables, the current stage has processed"""
+    _counts.update({k: int(v) for k, v in counts.items()})
+
+
+def _cpu_time():
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+def _io_bytes():
+    """Return the bytes read and written by the process, or None, None"""
+    try:
+        with open('/proc/self/io') as f:
+            d = dict(line.split(':', 1) for line in f)
+        return int(d['rchar']), int(d['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _reset_peak_rss():
+    """Reset the peak resident set size of the process, on Linux"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _peak_rss():
+    """Return the peak resident set size of the process, in bytes"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return rss if sys.platform == 'darwin' else rss * 1024  # kB on Linux
+
+
+def measure(func, *args, **kwargs):
+    """Call a function, and return its result and a dict of measurements: 'wall_time' and 'cpu_time' in
+    seconds, 'peak_rss', 'read_bytes' and 'write_bytes' in bytes, and the counts the function reported
+    with count()"""
+
+    _counts.clear()
+    _reset_peak_rss()
+
+    read_bytes, write_bytes = _io_bytes()
+    cpu = _cpu_time()
+    t = perf_counter()
+
+    result = func(*args, **kwargs)
+
+    wall = perf_counter() - t
+    cpu = _cpu_time() - cpu
+    read_end, write_end = _io_bytes()
+
+    metrics = {
+        'wall_time': round(wall, 3),
+        'cpu_time': round(cpu, 3),
+        'peak_rss': _peak_rss(),
+        'read_bytes': read_end - read_bytes if read_bytes is not None else None,
+        'write_bytes': write_end - write_bytes if write_bytes is not None else None,
+    }
+
+    metrics.update(_counts)
+
+    return result, metrics
@@ -5,7 +5,6 @@
 
 """
 
-from functools import lru_cache
 from functools import reduce
 from pathlib import Path
 from warnings import warn
@@ -16,6 +15,10 @@ import pandas as pd
 from rowgenerators import Source
 from rowgenerators.appurl.web import WebUrl
 
+from . import NlsyError
+from .h5 import chunk_cache_size
+from .store import INDEX_COLUMNS, ColumnCache, ColumnIndex, Hdf5Store, MmapStore, ParquetStore
+
 
 class NlsyUrl(WebUrl):
     pass
@@ -38,21 +41,70 @@ class NLSY(object):
 
     }
 
-    def __init__(self, hdf):
+    def __init__(self, path, backend=None, chunk_cache='auto', cache_bytes=2 ** 30):
+        """
+        :param path: Path to the HDF5 file or Parquet directory, or to the archive directory that holds one of them.
+            With backend='parquet', a path to the HDF5 file is to the Parquet directory next to it
+        :param backend: 'hdf5', 'parquet' or 'mmap'. If None, determine the backend from the path. 'mmap'
+            reads the survey data from the memory mapped directory written by h5.convert_mmap(), next to
+            the HDF5 file, and returns dataframes that are views of the mapping. Metadata is read from the HDF5 file.
+        :param chunk_cache: HDF5 raw data chunk cache settings, as a dict of h5py.File() rdcc_* kwargs.
+            If 'auto', size the cache to the chunk layout of the survey dataset. If None, use the h5py defaults
+        :param cache_bytes: Maximum total bytes of the survey columns that are kept in memory, to make later
+            dataframes from. 0 disables the cache. Columns from the 'mmap' backend are not cached, because
+            reading them does not copy
+        """
 
-        self.hdf_file = Path(hdf)
+        path = Path(path)
 
-        if self.hdf_file.is_dir():
+        if path.is_dir() and path.suffix != '.parquet':
             # Assume it is an archive directory, properly named
-            self.hdf_file = self.hdf_file.joinpath(self.hdf_file.name + '.h5')
+            if backend == 'parquet' or (backend is None and not path.joinpath(path.name + '.h5').exists()
+                                        and path.joinpath(path.name + '.parquet').exists()):
+                path = path.joinpath(path.name + '.parquet')
+            else:
+                path = path.joinpath(path.name + '.h5')
+
+        if backend is None:
+            backend = 'parquet' if path.suffix == '.parquet' else 'hdf5'
+
+        if backend == 'parquet' and path.suffix != '.parquet':
+            # The path to the HDF5 file, which the Parquet directory is written next to
+            path = path.with_suffix('.parquet')
+
+        if backend == 'parquet' and not path.is_dir():
+            raise NlsyError(f"No Parquet directory at '{path}'. Write one with parquet.convert_parquet()")
+
+        self.path = path
+        self.backend = backend
+        self.base_name = path.stem
+
+        if backend in ('hdf5', 'mmap'):
+            self.hdf_file = path
+
+            if chunk_cache == 'auto' and backend == 'hdf5':
+                with h5py.File(self.hdf_file, 'r') as f:
+                    chunk_cache = chunk_cache_size(f[self.base_name]) if self.base_name in f else None
 
-        self.f = h5py.File(self.hdf_file, 'r')
+            self.f = h5py.File(self.hdf_file, 'r', **(chunk_cache if isinstance(chunk_cache, dict) else {}))
 
-        self.base_name = Path(self.hdf_file).stem
+            if backend == 'mmap':
+                self.store = MmapStore(self.f, self.base_name, self.hdf_file.with_suffix('.mmap'))
+            else:
+                self.store = Hdf5Store(self.f, self.base_name)
+
+        elif backend == 'parquet':
+            self.store = ParquetStore(path)
+
+        else:
+            raise ValueError(f"Unknown backend '{backend}'; must be 'hdf5', 'parquet' or 'mmap'")
+
+        self.column_cache = ColumnCache(self.store, 0 if backend == 'mmap' else cache_bytes)
 
         self._metadata = None
         self._value_labels = None
         self._column_map = None
+        self._column_index = None
         self._question_map = None
         self._respondent_meta = None
 
@@ -66,15 +118,16 @@ class NLSY(object):
     @property
     def metadata(self):
         if self._metadata is None:
-            self._metadata = self._get_dataframe(self.base_name + '_variable_labels')
+            self._metadata = self.store.read_table('variable_labels')
 
-            # Fix brokenness
-            #  https://github.com/Metatab/publicdata/issues/7
-            for col in ['var_no', 'col_no', 'labels_id', 'is_categorical']:
-                self._metadata[col].replace('nan', np.nan, inplace=True)
-                self._metadata[col] = pd.to_numeric(self._metadata[col])
+            if not self.store.typed_tables:
+                # Fix brokenness in files with all-string metadata tables
+                #  https://github.com/Metatab/publicdata/issues/7
+                for col in ['var_no', 'col_no', 'labels_id', 'is_categorical']:
+                    self._metadata[col] = self._metadata[col].replace('nan', np.nan)
+                    self._metadata[col] = pd.to_numeric(self._metadata[col])
 
-            self._metadata.replace(['nan'], [None], inplace=True)
+                self._metadata.replace(['nan'], [None], inplace=True)
 
             self._metadata.at[1, 'is_categorical'] = 1
 
@@ -83,9 +136,10 @@ class NLSY(object):
     @property
     def valuelabels(self):
         if self._value_labels is None:
-            self._value_labels = self._get_dataframe(self.base_name + '_value_labels')
+            self._value_labels = self.store.read_table('value_labels')
 
-            self._value_labels['value'] = pd.to_numeric(self._value_labels['value'])
+            if not self.store.typed_tables:
+                self._value_labels['value'] = pd.to_numeric(self._value_labels['value'])
 
             self._value_labels.dropna(inplace=True)
 
@@ -132,35 +186,45 @@ class NLSY(object):
     @property
     def column_map(self):
         if self._column_map is None:
-            # This method is much faster than building a dataframe and iterating over it
-
-            headers = list(self.f[self.base_name + '_variable_labels_headers'])
+            # This method is much faster than building a dataframe for all of the metadata
 
-            ds = self.f[self.base_name + '_variable_labels']
+            t = self.store.read_table('variable_labels',
+                                      ['col_no', 'variable_name', 'variable_name_nd', 'question_name'])
 
-            cn = headers.index('col_no')
-
-            d = {k: v for v, k in ds[:, [cn, headers.index('variable_name')]]}
-            d.update({k: v for v, k in ds[:, [cn, headers.index('variable_name_nd')]]})
-            d.update({k: v for v, k in ds[:, [cn, headers.index('question_name')]]})
+            d = dict(zip(t.variable_name, t.col_no))
+            d.update(zip(t.variable_name_nd, t.col_no))
+            d.update(zip(t.question_name, t.col_no))
 
             self._column_map = d
 
         return self._column_map
 
     @property
-    def question_map(self):
-        if self._question_map is None:
-            # This method is much faster than building a dataframe and iterating over it
+    def column_index(self):
+        """A store.ColumnIndex of variable names, variable names without the dot and question names to
+        column numbers. It is read from the HDF5 file, or made from the metadata for files without one"""
+        if self._column_index is None:
+            self._column_index = self.store.column_index()
 
-            headers = list(self.f[self.base_name + '_variable_labels_headers'])
+            if self._column_index is None:
+                t = self.store.read_table('variable_labels', ['col_no'] + list(INDEX_COLUMNS))
+                self._column_index = ColumnIndex.from_table(t)
 
-            ds = self.f[self.base_name + '_variable_labels']
+        return self._column_index
 
-            cn = headers.index('col_no')
+    def match_columns(self, pattern):
+        """Return the sorted column numbers of the columns with a name that matches a glob pattern,
+        such as 'YSCH-20500*'"""
+        return sorted(set(self.column_index.glob(pattern).values()))
 
-            self._question_map = dict(ds[:, [headers.index('variable_name_nd'),
-                                             headers.index('question_name')]])
+    @property
+    def question_map(self):
+        if self._question_map is None:
+            # This method is much faster than building a dataframe for all of the metadata
+
+            t = self.store.read_table('variable_labels', ['variable_name_nd', 'question_name'])
+
+            self._question_map = dict(zip(t.variable_name_nd, t.question_name))
 
         return self._question_map
 
@@ -193,32 +257,97 @@ class NLSY(object):
 
         return df
 
-    @lru_cache()
-    def _get_dataframe(self, name, col_nos=None):
-        ds = self.f[name]
-        headers = self.f[name + '_headers']
+    def _get_columns(self, col_nos=None, rows=None, cache=None):
+        """Return a dataframe of columns of the survey data. The columns have the
+        integer types they were stored with. They are copied from the arrays the column cache returns, which
+        are read-only, except for the 'mmap' backend, where the dataframe is a read-only view of the mapping.
+        If `rows` is a sorted array of row numbers, return only those rows, indexed by row number. `cache` is
+        the ColumnCache to read through, if not self.column_cache"""
+
+        if col_nos is None:
+            col_nos = range(self.store.shape[1])
+
+        headers = self.store.headers
+
+        cache = cache if cache is not None else self.column_cache
+
+        df = pd.DataFrame(dict(enumerate(cache.read_columns(col_nos, rows))),
+                          copy=self.backend != 'mmap')
+        df.columns = [headers[c] for c in col_nos]
+
+        if rows is not None:
+            df.index = pd.Index(rows)
+
+        return df
+
+    def _map_columns(self, names):
+        """Return the sorted column numbers for column numbers, names and glob patterns"""
+
+        def mapcolno(n):
+            try:
+                return [int(n)]
+            except ValueError:
+                if any(c in n for c in '*?['):
+                    return self.match_columns(n)
+
+                return [self.column_index.get(n)]
 
-        if col_nos:
-            # col_nos must be a list! a tuple will index differently
-            return pd.DataFrame(ds[:, list(col_nos)], columns=list(headers[list(col_nos)]))
+        col_nos = [c for n in names for c in mapcolno(n)]
+
+        return tuple(sorted([int(n) for n in col_nos if n is not None]))
+
+    def select_rows(self, where=None):
+        """Return the sorted row numbers of the respondents that match a predicate, or None for all rows.
+
+        :param where: A dict of column names, usually respondent columns, to a value or a list of values,
+            such as {'KEY!SEX': 2} or {'PUBID': [1, 5, 19]}, which matches rows where all of the columns
+            have one of their values. Or, a function that is called with the respondent_meta dataframe
+            and returns a boolean series, like lambda r: r['KEY!SEX'] == 2
+        :return: An array of row numbers
+        """
+
+        if where is None:
+            return None
+
+        if callable(where):
+            mask = np.asarray(where(self.respondent_meta), dtype=bool)
         else:
-            return pd.DataFrame(ds[:], columns=list(headers[:]))
+            col_nos = []
+            for name in where:
+                col_no = self.column_index.get(name)
+                if col_no is None:
+                    raise KeyError(f"No column for '{name}'")
+                col_nos.append(col_no)
+
+            mask = np.ones(self.store.shape[0], dtype=bool)
+
+            # Only the columns in the predicate are read, for all rows
+            for a, values in zip(self.column_cache.read_columns(col_nos), where.values()):
+                if isinstance(values, (list, tuple, set, frozenset, np.ndarray, pd.Series)):
+                    mask &= np.isin(a, list(values))
+                else:
+                    mask &= a == values
 
-    def get_dataframe(self, col_nos=None):
-        """Return a dataframe, with headers from the NLSY HDF5 file"""
+        return np.flatnonzero(mask)
+
+    def get_dataframe(self, col_nos=None, where=None):
+        """Return a dataframe, with headers from the NLSY HDF5 file. Columns are column numbers,
+        variable names or question names, or glob patterns, like 'YSCH-20500*', that match names.
+
+        If `where` is given, it selects respondents, as for select_rows(), and only their rows of the
+        columns are read. The dataframe is indexed by the row numbers of the respondents"""
+
+        rows = self.select_rows(where)
 
         if col_nos is None:
-            return self._get_dataframe(self.base_name, col_nos=None)
+            return self._get_columns(col_nos=None, rows=rows)
         else:
-            def mapcolno(n):
-                try:
-                    return int(n)
-                except ValueError:
-                    return self.column_map.get(n)
-
-            col_nos = sorted([int(mapcolno(n)) for n in col_nos if mapcolno(n)])
+            return self._get_columns(col_nos=self._map_columns(col_nos), rows=rows)
 
-            return self._get_dataframe(self.base_name, col_nos=tuple(col_nos))
+    @property
+    def base_questions(self):
+        """A list of all of the base questions, except PUBID"""
+        return list(e for e in self.metadata.base_qn.unique() if e != 'PUBID')
 
     def base_question_columns(self, base_qn):
 
@@ -226,7 +355,8 @@ class NLSY(object):
 
         return list(m[m.base_qn == base_qn].variable_name_nd)
 
-    def _question_dataframe(self, base_qn, rmeta=True, cmeta=True, replacena=False, agg=None):
+    def _question_dataframe(self, base_qn, rmeta=True, cmeta=True, replacena=False, agg=None, rows=None,
+                            cache=None):
         """
         Return a dataframe with all columns for a base question, linked to the column metadata
         and some respondent data. The dataframe will be pivoted so there is a single
@@ -236,6 +366,8 @@ class NLSY(object):
         :param base_qn:
         :param rmeta:
         :param cmeta:
+        :param rows: Sorted row numbers of the respondents to include, from select_rows(), or None for all
+        :param cache: ColumnCache to read the question's columns through, if not self.column_cache
         :return:
         """
 
@@ -249,12 +381,16 @@ class NLSY(object):
         if not cols:
             return None
 
-        df = self[cols]
+        df = self._get_columns(self._map_columns(cols), rows, cache)
 
         respondent_meta = self.respondent_meta
 
-        # Maybe didn't get all of the respondent meta columns, so reset to the ones we have
-        rmeta =[ c for c in self.respondent_meta.columns if c in rmeta]
+        if rows is not None:
+            respondent_meta = respondent_meta.iloc[rows]
+
+        # Maybe didn't get all of the respondent meta columns, so reset to the ones we have. The
+        # question itself may be a respondent column, and then it is the value column
+        rmeta = [c for c in respondent_meta.columns if c in rmeta and c != base_qn]
 
         assert len(respondent_meta) == len(df)
 
@@ -294,7 +430,8 @@ class NLSY(object):
 
         return t
 
-    def question_dataframe(self, base_qn=None, rmeta=True, cmeta=True, replacena=True, dropna=True, agg=None):
+    def question_dataframe(self, base_qn=None, rmeta=True, cmeta=True, replacena=True, dropna=True, agg=None,
+                           where=None):
         """
         :param base_qn:  Base question, either a single string, or a list of string question names. If None, use all questions
         :param rmeta: If True, link in respondent metadata. Defaults to True
@@ -302,8 +439,13 @@ class NLSY(object):
         :param replacena: If true, replace negative values with Nan. Defaults to True
         :param dropna: If true, drop columns that are all null. Defaults to True
         :param agg: If set, group the dataframe on PUBID and survey year, and apply this aggregation function
+        :param where: If set, only include the respondents that match, as for select_rows(). The predicate
+            is evaluated once, and only the matching rows of the question columns are read
         :return:
 
+        With a list of questions, or all of them, the question dataframes are joined, which takes memory for
+        all of them. To process many questions, use iter_question_dataframes(), or export_questions() to
+        write them to Parquet files.
 
         The `agg` parameter is important for questions that  have multiples dimensions, such as YSCH-20500.01.02,
         which has two extra dimensions, for college # ( '01' ) and term #, ('02'). Question dataframes with
@@ -331,8 +473,10 @@ class NLSY(object):
 
         """
 
+        rows = self.select_rows(where)
+
         if base_qn is None:
-            base_qn = list(e for e in self.metadata.base_qn.unique() if e != 'PUBID')
+            base_qn = self.base_questions
 
         if isinstance(base_qn, (list, tuple)):
 
@@ -342,15 +486,8 @@ class NLSY(object):
                 if e not in base_qn:
                     base_qn.append(e)
 
-            def get_agg(base_qn):
-
-                try:
-                    return agg.get(base_qn)
-                except AttributeError:
-                    return agg
-
             frames = [self._question_dataframe(e.strip(), False, True,
-                                               replacena=replacena, agg=get_agg(e.strip()))
+                                               replacena=replacena, agg=_question_agg(agg, e.strip()), rows=rows)
                       for e in base_qn]
 
             index_cols = list(reduce(lambda x, y: x | set(y.columns[:-1]), frames, set()))
@@ -392,13 +529,50 @@ class NLSY(object):
                 df = df[df_cols].join(self.respondent_meta.set_index('PUBID'))
 
         else:
-            df = self._question_dataframe(base_qn.strip(), rmeta, cmeta, replacena, agg)
+            df = self._question_dataframe(base_qn.strip(), rmeta, cmeta, replacena, agg, rows=rows)
 
         if dropna:
             return df.reset_index().dropna(axis=1, how='all')  # drops columns with no values
         else:
             return df.reset_index()
 
+    def iter_question_dataframes(self, base_qn=None, rmeta=True, cmeta=True, replacena=True, dropna=True,
+                                 agg=None, where=None):
+        """Yield tuples of a base question and its question dataframe, as question_dataframe() returns it for
+        the single question, for a list of base questions, or all of them if `base_qn` is None. The frames
+        are not joined, so only one of them is in memory at a time. Each question's columns are read once,
+        so they are read from the store without going through the column cache.
+
+        The other parameters are the same as for question_dataframe(), and `where` is evaluated once for
+        all of the questions"""
+
+        rows = self.select_rows(where)
+
+        if base_qn is None:
+            base_qn = self.base_questions
+        elif isinstance(base_qn, str):
+            base_qn = [base_qn]
+
+        uncached = ColumnCache(self.store, 0)
+
+        for e in dict.fromkeys(e.strip() for e in base_qn):
+            df = self._question_dataframe(e, rmeta, cmeta, replacena, _question_agg(agg, e), rows=rows,
+                                          cache=uncached)
+
+            if df is None:
+                continue
+
+            df = df.reset_index()
+
+            yield e, df.dropna(axis=1, how='all') if dropna else df
+
+    def export_questions(self, parquet_dir, base_qn=None, partition='base_qn', **kwargs):
+        """Write question dataframes to a directory of Parquet files, one question at a time.
+        See parquet.export_questions()"""
+        from .parquet import export_questions
+
+        return export_questions(self, parquet_dir, base_qn, partition, **kwargs)
+
     def categoricalize(self, df, columns=None):
         """Convert all of the categorical columns.
         The columns must have question names, not variable names. """
@@ -436,6 +610,14 @@ class NLSY(object):
         self.close()
 
 
+def _question_agg(agg, base_qn):
+    """Return the aggregation function for a question, from a dict of them, or the one for all questions"""
+    try:
+        return agg.get(base_qn)
+    except AttributeError:
+        return agg
+
+
 class NLSY97(NLSY):
     # Variables that only appear in one year.
 
@@ -0,0 +1,138 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# MIT License, included in this distribution as LICENSE
+
+"""
+Write the survey data and metadata from an NLSY HDF5 file to a directory of Parquet files,
+which NLSY can open with backend='parquet'. Requires pyarrow.
+
+The directory, named like the HDF5 file but with a .parquet extension, has:
+
+* survey.parquet: The survey matrix, one column per variable, with the types of the HDF5 columns
+* variable_labels.parquet, value_labels.parquet, reduced_value_labels.parquet: the metadata tables
+
+export_questions() writes question dataframes, the long form that NLSY.question_dataframe()
+returns, to a directory with a Parquet file per base question, or a directory per base
+question with a file per survey year. The questions are written one at a time, so, unlike
+joining all of them with question_dataframe(), memory is bounded by the largest question.
+
+"""
+
+import re
+from pathlib import Path
+
+import h5py
+from tqdm import tqdm
+
+from .instrument import count
+from .store import TABLES, Hdf5Store
+
+
+def convert_parquet(hdf5_file, parquet_dir=None, row_group_bytes=2 ** 26, compression='zstd'):
+    """Convert an NLSY HDF5 file, with metadata, to a directory of Parquet files"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    hdf5_file = Path(hdf5_file)
+    base = hdf5_file.stem
+
+    parquet_dir = Path(parquet_dir) if parquet_dir else hdf5_file.with_suffix('.parquet')
+    parquet_dir.mkdir(parents=True, exist_ok=True)
+
+    with h5py.File(hdf5_file, 'r') as f:
+        store = Hdf5Store(f, base)
+
+        nrows, ncols = store.shape
+        dtypes = store.dtypes
+
+        count(rows=nrows, variables=ncols)
+
+        schema = pa.schema([(name, pa.from_numpy_dtype(dtype)) for name, dtype in zip(store.headers, dtypes)])
+
+        row_group_rows = max(1, row_group_bytes // max(1, sum(dt.itemsize for dt in dtypes)))
+
+        with pq.ParquetWriter(parquet_dir.joinpath('survey.parquet'), schema, compression=compression) as w:
+            for row_n in tqdm(range(0, nrows, row_group_rows), ncols=80, desc='Write Parquet'):
+                columns = store.read_columns(range(ncols), rows=slice(row_n, row_n + row_group_rows))
+                w.write_table(pa.Table.from_arrays(columns, schema=schema))
+
+        for table in TABLES:
+            if base + '_' + table in f:
+                df = store.read_table(table)
+                pq.write_table(pa.Table.from_pandas(df, preserve_index=False),
+                               parquet_dir.joinpath(table + '.parquet'), compression=compression)
+
+    return parquet_dir
+
+
+def _question_file_name(base_qn):
+    """Return a base question name that is safe to use as a file name"""
+    return re.sub(r'[^\w!~.-]', '_', base_qn)
+
+
+def export_questions(nlsy, parquet_dir, base_qn=None, partition='base_qn', compression='zstd', **kwargs):
+    """Write the question dataframes for a list of base questions, or all of them, to a directory of Parquet
+    files, and return a dict of base question to the list of files written for it.
+
+    :param nlsy: An NLSY object
+    :param parquet_dir: Directory to write to
+    :param base_qn: A list of base questions, or None for all of them
+    :param partition: 'base_qn' to write each question to <base_qn>.parquet, or 'survey_year' to write
+        each question to a <base_qn> directory, with a <survey_year>.parquet file for each year. Questions
+        without a survey_year column, such as those without column metadata, are written to one file.
+        The files of the questions from an earlier export, in either layout, are removed first.
+    :param compression: Parquet compression codec
+    :param kwargs: Other arguments to NLSY.iter_question_dataframes(), such as rmeta, agg and where
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if partition not in ('base_qn', 'survey_year'):
+        raise ValueError(f"Unknown partition '{partition}'; must be 'base_qn' or 'survey_year'")
+
+    parquet_dir = Path(parquet_dir)
+    parquet_dir.mkdir(parents=True, exist_ok=True)
+
+    if base_qn is None:
+        base_qn = nlsy.base_questions
+    elif isinstance(base_qn, str):
+        base_qn = [base_qn]
+
+    # Remove the files of the questions from an earlier export, including questions that have no
+    # dataframe now
+    for qn in base_qn:
+        name = _question_file_name(qn.strip())
+
+        parquet_dir.joinpath(name + '.parquet').unlink(missing_ok=True)
+
+        qn_dir = parquet_dir.joinpath(name)
+        if qn_dir.is_dir():
+            for f in qn_dir.glob('*.parquet'):
+                f.unlink()
+            if not any(qn_dir.iterdir()):
+                qn_dir.rmdir()
+
+    files = {}
+
+    for qn, df in tqdm(nlsy.iter_question_dataframes(base_qn, **kwargs), total=len(base_qn), ncols=80,
+                       desc='Export questions'):
+
+        name = _question_file_name(qn)
+        qn_file = parquet_dir.joinpath(name + '.parquet')
+        qn_dir = parquet_dir.joinpath(name)
+
+        if partition == 'survey_year' and 'survey_year' in df.columns:
+            qn_dir.mkdir(exist_ok=True)
+
+            parts = [(qn_dir.joinpath(_question_file_name(str(year)) + '.parquet'), g)
+                     for year, g in df.groupby('survey_year', sort=True)]
+        else:
+            parts = [(qn_file, df)]
+
+        for f, part in parts:
+            pq.write_table(pa.Table.from_pandas(part, preserve_index=False), f, compression=compression)
+
+        files[qn] = [f for f, _ in parts]
+
+        count(rows=len(df), variables=1)
+
+    return files
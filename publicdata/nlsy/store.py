@@ -0,0 +1,436 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# MIT License, included in this distribution as LICENSE
+
+"""
+Readers for the survey data matrix, the respondents by variables table of responses,
+and the metadata tables that go with it
+"""
+
+from functools import cached_property
+from pathlib import Path
+
+import h5py
+import numpy as np
+import pandas as pd
+
+# Metadata tables, with names relative to the survey dataset name
+TABLES = ('variable_labels', 'value_labels', 'reduced_value_labels')
+
+# Names that are looked up in the column index, in order of precedence, with later names winning
+INDEX_COLUMNS = ('variable_name', 'variable_name_nd', 'question_name')
+
+
+class ColumnIndex(object):
+    """A sorted index of the variable names, variable names without the dot and question names of the
+    survey columns to column numbers. Names are found with a binary search, and can be matched by a
+    prefix or a glob pattern. The names are a numpy array of fixed length, UTF-8 encoded, bytes"""
+
+    def __init__(self, names, col_nos):
+        self.names = np.asarray(names)
+        self.col_nos = np.asarray(col_nos)
+
+    @classmethod
+    def from_table(cls, t):
+        """Make an index from a variable_labels table, with at least the col_no and INDEX_COLUMNS columns"""
+
+        d = {}
+        for c in INDEX_COLUMNS:
+            d.update((str(k).encode('utf8'), int(v)) for k, v in zip(t[c], t.col_no) if not pd.isna(k))
+
+        names = sorted(d)
+
+        return cls(np.array(names, dtype=bytes) if names else np.array([], dtype='S1'),
+                   np.array([d[k] for k in names], dtype=np.int32))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def get(self, name, default=None):
+        """Return the column number for a name"""
+
+        key = str(name).encode('utf8')
+
+        i = np.searchsorted(self.names, key)
+
+        if i < len(self.names) and self.names[i] == key:
+            return int(self.col_nos[i])
+
+        return default
+
+    def _range(self, prefix):
+        key = prefix.encode('utf8')
+
+        # No UTF-8 byte is 0xff, so it sorts after every name with the prefix
+        return np.searchsorted(self.names, key), np.searchsorted(self.names, key + b'\xff')
+
+    def prefix(self, prefix):
+        """Return a dict of the names that start with a prefix to their column numbers, in name order"""
+
+        lo, hi = self._range(prefix)
+
+        return {k.decode('utf8'): int(v) for k, v in zip(self.names[lo:hi], self.col_nos[lo:hi])}
+
+    def glob(self, pattern):
+        """Return a dict of the names that match a glob pattern, such as 'YSCH-20500*', to their column
+        numbers, in name order. Only the names that start with the part of the pattern before the
+        first wildcard are compared to it"""
+        import fnmatch
+        import re
+
+        regex = re.compile(fnmatch.translate(pattern))
+
+        prefix = re.split(r'[*?\[]', pattern, maxsplit=1)[0]
+
+        return {k: v for k, v in self.prefix(prefix).items() if regex.match(k)}
+
+    def items(self):
+        return ((k.decode('utf8'), int(v)) for k, v in zip(self.names, self.col_nos))
+
+
+def coalesce(positions, chunk_cols=1, max_gap=16):
+    """Group sorted, unique column positions into slabs, a list of (start, stop) ranges of columns that
+    are read together. A position joins the slab before it if it is in the same chunk as the last position
+    of the slab, so each chunk is decompressed once, or if there are no more than `max_gap` columns between
+    them"""
+
+    slabs = []
+
+    for p in positions:
+        p = int(p)
+
+        if slabs:
+            start, stop = slabs[-1]
+            last = stop - 1
+
+            if p - last - 1 <= max_gap or p // chunk_cols == last // chunk_cols:
+                slabs[-1] = (start, p + 1)
+                continue
+
+        slabs.append((p, p + 1))
+
+    return slabs
+
+
+class Hdf5Store(object):
+    """Read columns of the survey matrix from an HDF5 file. The matrix may be a single
+    int32 dataset, or a group of datasets with one per integer type, as written by
+    convert_nlsy(downcast=True)"""
+
+    # Largest number of unselected columns between two selected ones that are read in one slab
+    max_gap = 16
+
+    def __init__(self, f, name):
+        self.f = f
+        self.name = name
+
+        node = f[name]
+
+        if isinstance(node, h5py.Dataset):
+            self.datasets = {4: node}
+            self.shape = node.shape
+            self.col_dtype = np.full(self.shape[1], 4, dtype=np.uint8)
+            self.col_index = np.arange(self.shape[1])
+        else:
+            self.datasets = {ds.dtype.itemsize: ds for k, ds in node.items() if k.startswith('int')}
+            self.shape = tuple(int(e) for e in node.attrs['shape'])
+            self.col_dtype = node['col_dtype'][:]
+            self.col_index = node['col_index'][:]
+
+    @cached_property
+    def headers(self):
+        """Column names of the matrix. They are read from the file once, on first use, because files
+        without metadata don't have them"""
+        return list(self.f[self.name + '_headers'].asstr()[:])
+
+    @property
+    def dtypes(self):
+        """Numpy type of each column of the matrix"""
+        return [self.datasets[itemsize].dtype for itemsize in self.col_dtype]
+
+    def read_columns(self, col_nos, rows=None):
+        """Return a list of 1D arrays, one for each of the column numbers, in the same order.
+        Each column has the type it was stored with. If `rows` is a slice, or a sorted array of row
+        numbers, return only those rows"""
+
+        col_nos = np.asarray(col_nos, dtype=np.int64)
+
+        rows = slice(None) if rows is None else rows
+
+        columns = [None] * len(col_nos)
+
+        for itemsize, ds in self.datasets.items():
+            sel = np.flatnonzero(self.col_dtype[col_nos] == itemsize)
+
+            if len(sel) == 0:
+                continue
+
+            positions, inverse = np.unique(self.col_index[col_nos[sel]], return_inverse=True)
+
+            a = self._read_positions(ds, positions, rows)
+
+            for i, j in zip(sel, inverse):
+                columns[i] = a[:, j]
+
+        return columns
+
+    def _read_positions(self, ds, positions, rows):
+        """Read the columns at sorted, unique positions in a dataset, as a 2D array. Rather than
+        selecting the columns with h5py fancy indexing, which is slow for many columns, the columns are
+        read in slabs of contiguous columns, from coalesce(), and selected in memory. When `rows` is an
+        array of row numbers, the rows are coalesced into slabs in the same way"""
+
+        chunk_rows, chunk_cols = ds.chunks if ds.chunks else (1, 1)
+
+        slabs = coalesce(positions, chunk_cols, self.max_gap)
+
+        if isinstance(rows, slice):
+            if len(slabs) == 1 and slabs[0][1] - slabs[0][0] == len(positions):
+                return ds[rows, slabs[0][0]:slabs[0][1]]
+
+            row_slabs = [(rows, None)]
+            nrows = len(range(*rows.indices(ds.shape[0])))
+        else:
+            rows = np.asarray(rows, dtype=np.int64)
+            nrows = len(rows)
+
+            # Each row slab, and the positions of the selected rows in it
+            row_slabs = []
+            for start, stop in coalesce(rows, chunk_rows, self.max_gap):
+                lo, hi = np.searchsorted(rows, [start, stop])
+                row_slabs.append((slice(start, stop), rows[lo:hi] - start))
+
+        a = np.empty((nrows, len(positions)), dtype=ds.dtype)
+
+        i = 0
+        for start, stop in slabs:
+            n = int(np.searchsorted(positions, stop)) - i
+            cols = positions[i:i + n] - start
+
+            r = 0
+            for row_slice, row_idx in row_slabs:
+                slab = ds[row_slice, start:stop]
+
+                if row_idx is None:
+                    a[:, i:i + n] = slab[:, cols]
+                else:
+                    a[r:r + len(row_idx), i:i + n] = slab[np.ix_(row_idx, cols)]
+                    r += len(row_idx)
+
+            i += n
+
+        return a
+
+    @property
+    def typed_tables(self):
+        """True if the metadata tables were written with h5.write_table(), rather than
+        as all-string datasets"""
+        return isinstance(self.f.get(self.name + '_variable_labels'), h5py.Group)
+
+    def column_index(self):
+        """Return the ColumnIndex written by h5.write_column_index(), or None if the file doesn't have one"""
+
+        g = self.f.get(self.name + '_column_index')
+
+        if g is None:
+            return None
+
+        return ColumnIndex(g['names'][:], g['col_no'][:])
+
+    def read_table(self, table, columns=None):
+        """Return a metadata table as a dataframe, optionally with only some of the columns"""
+        from .h5 import read_table
+
+        name = self.name + '_' + table
+
+        if isinstance(self.f[name], h5py.Group):
+            return read_table(self.f, name, columns)
+
+        headers = list(self.f[name + '_headers'].asstr()[:])
+
+        ds = self.f[name].asstr()
+
+        if columns is None:
+            return pd.DataFrame(ds[:], columns=headers)
+        else:
+            idx = [headers.index(c) for c in columns]
+            return pd.DataFrame(ds[:, sorted(idx)], columns=[headers[i] for i in sorted(idx)])[columns]
+
+
+class MmapStore(Hdf5Store):
+    """Read columns of the survey matrix from uncompressed, column-major .npy files, as
+    written by h5.convert_mmap(), which are memory mapped, so columns are views of the
+    mapping and reading them does not copy. Metadata tables are read from the HDF5 file"""
+
+    def __init__(self, f, name, mmap_dir):
+        self.f = f
+        self.name = name
+        self.mmap_dir = Path(mmap_dir)
+
+        self.col_dtype = np.load(self.mmap_dir.joinpath('col_dtype.npy'))
+        self.col_index = np.load(self.mmap_dir.joinpath('col_index.npy'))
+
+        self.datasets = {}
+        for itemsize in np.unique(self.col_dtype):
+            mm = np.load(self.mmap_dir.joinpath(f'int{itemsize * 8}.npy'), mmap_mode='r')
+            # Plain ndarray views of the mapping, so frames don't hold np.memmap objects
+            self.datasets[mm.dtype.itemsize] = mm.view(np.ndarray)
+
+        nrows = len(next(iter(self.datasets.values()))) if self.datasets else 0
+        self.shape = (nrows, len(self.col_dtype))
+
+    def read_columns(self, col_nos, rows=None):
+        """Return a list of 1D arrays, one for each of the column numbers, in the same order.
+        The arrays are read-only views of the memory mapped files. If `rows` is a slice,
+        return only those rows, and if it is an array of row numbers, copies of those rows"""
+
+        rows = slice(None) if rows is None else rows
+
+        return [self.datasets[self.col_dtype[c]][rows, self.col_index[c]] for c in col_nos]
+
+
+class ColumnCache(object):
+    """A least recently used cache of whole columns of the survey matrix, read from a store, and bounded by
+    the total bytes of the columns. A request is made from the cached columns, and only the missing columns
+    are read from the store, in one read. The cached arrays are read-only, so frames made from them can't
+    change the cache. With `max_bytes` of 0, columns are read from the store without caching them"""
+
+    def __init__(self, store, max_bytes=2 ** 30):
+        from collections import OrderedDict
+
+        self.store = store
+        self.max_bytes = max_bytes
+        self.columns = OrderedDict()  # Column number to array, least recently used first
+        self.nbytes = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def read_columns(self, col_nos, rows=None):
+        """Return a list of 1D arrays, one for each of the column numbers, in the same order. If `rows`
+        is a slice or a sorted array of row numbers, return only those rows. Selections of rows are
+        made from the cached columns, but columns that are not cached are read with only those rows,
+        and are not cached"""
+
+        if not self.max_bytes:
+            return self.store.read_columns(col_nos, rows)
+
+        col_nos = [int(c) for c in col_nos]
+
+        if rows is not None:
+            missing = [c for c in dict.fromkeys(col_nos) if c not in self.columns]
+
+            arrays = dict(zip(missing, self.store.read_columns(missing, rows))) if missing else {}
+
+            self.hits += len(col_nos) - len(missing)
+            self.misses += len(missing)
+
+            for c in col_nos:
+                if c not in arrays:
+                    arrays[c] = self.columns[c][rows]
+                    self.columns.move_to_end(c)
+
+            return [arrays[c] for c in col_nos]
+
+        missing = [c for c in dict.fromkeys(col_nos) if c not in self.columns]
+
+        arrays = {}
+
+        if missing:
+            for c, a in zip(missing, self.store.read_columns(missing)):
+                # Copy columns that are strided views of a larger read, so the cache doesn't hold the whole read
+                a = np.ascontiguousarray(a)
+                a.flags.writeable = False
+
+                arrays[c] = self.columns[c] = a
+                self.nbytes += a.nbytes
+
+        self.hits += len(col_nos) - len(missing)
+        self.misses += len(missing)
+
+        # The requested columns are the most recently used, in the order they were requested
+        for c in col_nos:
+            arrays.setdefault(c, self.columns[c])
+            self.columns.move_to_end(c)
+
+        while self.nbytes > self.max_bytes and self.columns:
+            _, a = self.columns.popitem(last=False)
+            self.nbytes -= a.nbytes
+
+        return [arrays[c] for c in col_nos]
+
+    def clear(self):
+        self.columns.clear()
+        self.nbytes = 0
+
+
+class ParquetStore(object):
+    """Read the survey matrix and metadata tables from a directory of Parquet files, as
+    written by parquet.convert_parquet(). Requires pyarrow"""
+
+    def __init__(self, path):
+        import pyarrow.parquet as pq
+
+        self.path = Path(path)
+        self.name = self.path.stem
+
+        self.pf = pq.ParquetFile(self.path.joinpath('survey.parquet'), memory_map=True)
+
+        self.shape = (self.pf.metadata.num_rows, self.pf.metadata.num_columns)
+
+    @cached_property
+    def headers(self):
+        """Column names of the matrix"""
+        return self.pf.schema_arrow.names
+
+    @property
+    def dtypes(self):
+        """Numpy type of each column of the matrix"""
+        return [np.dtype(t.to_pandas_dtype()) for t in self.pf.schema_arrow.types]
+
+    def read_columns(self, col_nos, rows=None):
+        """Return a list of 1D arrays, one for each of the column numbers, in the same order.
+        If `rows` is a slice, or a sorted array of row numbers, return only those rows"""
+
+        headers = self.headers
+
+        names = list(dict.fromkeys(headers[c] for c in col_nos))
+
+        t = self.pf.read(columns=names, use_threads=True)
+
+        if isinstance(rows, slice):
+            start, stop, step = rows.indices(len(t))
+
+            if step == 1:
+                t = t.slice(start, max(0, stop - start))
+            else:
+                t = t.take(np.arange(start, stop, step))
+        elif rows is not None:
+            t = t.take(np.asarray(rows))
+
+        arrays = {name: t.column(i).to_numpy() for i, name in enumerate(names)}
+
+        return [arrays[headers[c]] for c in col_nos]
+
+    @property
+    def typed_tables(self):
+        """True if the metadata tables have typed columns, rather than all strings"""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = pq.read_schema(self.path.joinpath('variable_labels.parquet'))
+
+        return pa.types.is_integer(schema.field('col_no').type)
+
+    def column_index(self):
+        """Parquet directories don't store a column index, so it is made from the variable_labels table"""
+        return None
+
+    def read_table(self, table, columns=None):
+        """Return a metadata table as a dataframe, optionally with only some of the columns"""
+        import pyarrow.parquet as pq
+
+        return pq.read_table(self.path.joinpath(table + '.parquet'), columns=columns,
+                             memory_map=True).to_pandas()
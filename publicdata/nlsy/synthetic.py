@@ -0,0 +1,322 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# MIT License, included in this distribution as LICENSE
+
+"""
+Write synthetic NLSY downloads, a .dat file of responses, a .cdb codebook and a .NLSY97
+header file, of any size, for tests and benchmarks.
+
+The codebook has the same layout as the NLSY97 codebook, so it exercises the same parsing
+and label processing paths. It starts with the respondent variables that NLSY97 links into
+question dataframes, followed by base questions that are asked over several survey years,
+and may have up to three dimensions and a component. Categorical questions draw their labels
+from a pool of label sets, with small variations in the labels between years, like the
+real codebook has, so label clustering has work to do.
+
+    python -m publicdata.nlsy.synthetic -r 10000 -v 2000 /tmp/synthetic
+
+"""
+
+import random
+from pathlib import Path
+
+import numpy as np
+
+
+# Words for label sets
+WORDS = ('yes no never rarely sometimes often always none some most all less more than once twice month week '
+         'year day school work home job college high grade degree married single divorced separated widowed '
+         'parent mother father brother sister child friend other refused know agree disagree strongly '
+         'somewhat very not at full part time employed unemployed retired student military public private '
+         'owner renter urban rural city town farm north south east west excellent good fair poor').split()
+
+QUESTION_GROUPS = ('YSCH', 'YEMP', 'YHEA', 'YINC', 'YHHI', 'YPRG', 'YSAQ', 'CV_HGC', 'CV_WKSWK', 'YIR')
+
+# Values for missing data
+NA_VALUES = (-1, -2, -3, -4, -5)
+
+RESPONDENT_LABELS = {
+    'KEY!SEX': ['Male', 'Female'],
+    'KEY!RACE': ['White', 'Black', 'American Indian, Eskimo, Or Aleut', 'Asian Or Pacific Islander', 'Other'],
+    'KEY!ETHNICITY': ['Yes', 'No', 'Unknown'],
+    'KEY!RACE_ETHNICITY': ['Black', 'Hispanic', 'Mixed Race (Non-Hispanic)', 'Non-Black / Non-Hispanic'],
+}
+
+
+class Variable(object):
+    """A column of the synthetic data, and how to generate its values"""
+
+    def __init__(self, question_name, survey_year, question, labels=None, lo=0, hi=100, na_frac=0.0):
+        self.question_name = question_name
+        self.survey_year = survey_year
+        self.question = question
+        self.labels = labels  # Dict of value to label, for categorical variables
+        self.lo = lo  # Range of values for variables without labels
+        self.hi = hi
+        self.na_frac = na_frac  # Fraction of values that are missing
+        self.variable_name = None
+
+    def values(self, rand, n):
+        if self.labels:
+            v = rand.choice(np.array(list(self.labels), dtype=np.int32), n)
+        else:
+            v = rand.integers(self.lo, self.hi + 1, n, dtype=np.int32)
+
+        if self.na_frac:
+            na = rand.random(n) < self.na_frac
+            v[na] = rand.choice(np.array(NA_VALUES, dtype=np.int32), int(na.sum()))
+
+        return v
+
+
+def _label_variant(rand, label):
+    """Return a label with the kind of differences that labels for the same value have between
+    survey years in the real codebook"""
+
+    r = rand.random()
+
+    if r < .6:
+        return label
+    elif r < .7:
+        return label.upper()
+    elif r < .8:
+        return label.lower()
+    elif r < .9:
+        return label + ' (Go To R{:05d}.00)'.format(rand.randrange(100000))
+    else:
+        # Drop a letter, a typo
+        i = rand.randrange(len(label))
+        return label[:i] + label[i + 1:] if len(label) > 3 else label
+
+
+def make_label_sets(rand, n):
+    """Return a list of `n` label sets, dicts of value to label"""
+
+    label_sets = []
+
+    for _ in range(n):
+        n_values = rand.randint(3, 12)
+        start = rand.choice((0, 1))
+
+        # Labels are unique within a set, or they can't be categories
+        labels = []
+        while len(labels) < n_values:
+            label = ' '.join(rand.sample(WORDS, rand.randint(1, 4))).capitalize()
+            if label not in labels:
+                labels.append(label)
+
+        label_sets.append(dict(zip(range(start, start + n_values), labels)))
+
+    return label_sets
+
+
+def make_variables(respondents=1000, variables=500, label_sets=50, years=5, dims=2,
+                   categorical_frac=0.6, seed=0):
+    """Return a list of Variables, the respondent variables and then the base questions,
+    up to `variables` columns in total.
+
+    :param respondents: Number of respondents, the range of PUBID
+    :param variables: Number of columns
+    :param label_sets: Number of distinct label sets for categorical questions
+    :param years: Maximum number of survey years for a base question
+    :param dims: Maximum number of dimensions of a base question, up to 3
+    :param categorical_frac: Fraction of base questions that are categorical
+    :param seed: Random seed
+    """
+
+    rand = random.Random(seed)
+
+    vars = [Variable('PUBID', '1997', 'PUBID, YOUTH CASE IDENTIFICATION CODE', lo=1, hi=respondents)]
+
+    for qn, labels in RESPONDENT_LABELS.items():
+        vars.append(Variable(qn, '1997', f'{qn}, RESPONDENT VARIABLE (SYMBOL)',
+                             labels={i: label for i, label in enumerate(labels, 1)}))
+
+        if qn == 'KEY!SEX':
+            vars.append(Variable('KEY!BDATE_Y', '1997', 'KEY!BDATE, RS BIRTHDATE MONTH/YEAR (SYMBOL)',
+                                 lo=1980, hi=1984))
+
+    pool = make_label_sets(rand, max(1, label_sets))
+
+    q_no = 0
+
+    while len(vars) < variables:
+        q_no += 1
+
+        base_qn = '{}-{:05d}'.format(rand.choice(QUESTION_GROUPS), q_no)
+        question = ' '.join(rand.sample(WORDS, rand.randint(3, 8))).upper()
+
+        labels = rand.choice(pool) if rand.random() < categorical_frac else None
+        lo, hi = rand.choice(((0, 1), (0, 100), (0, 30000), (0, 10 ** 6)))
+        na_frac = rand.choice((0, .1, .5))
+
+        n_dims = rand.randint(0, min(dims, 3))
+        dim_sizes = [rand.randint(1, 3) for _ in range(n_dims)]
+        component = rand.random() < .1
+
+        for year in range(1997, 1997 + rand.randint(1, years)):
+
+            year_labels = {v: _label_variant(rand, label) for v, label in labels.items()} if labels else None
+
+            for dim_values in np.ndindex(*dim_sizes):
+                qn = base_qn + ''.join('.{:02d}'.format(d + 1) for d in dim_values)
+
+                for c in (range(1, rand.randint(2, 4)) if component else [None]):
+                    vars.append(Variable(qn + ('~{:06d}'.format(c) if c else ''), str(year), question,
+                                         labels=year_labels, lo=lo, hi=hi, na_frac=na_frac))
+
+    vars = vars[:variables]
+
+    for i, var in enumerate(vars):
+        var.variable_name = 'R{:05d}.{:02d}'.format(i // 4 + 1, i % 4)
+
+    return vars
+
+
+def write_dat(dat_file, vars, respondents, block_rows=10000, seed=0):
+    """Write the survey responses, one line per respondent, and return a list of
+    value counts per variable, for the codebook"""
+
+    rand = np.random.default_rng(seed)
+
+    counts = [dict() for _ in vars]
+
+    with open(dat_file, 'w') as f:
+        for row_n in range(0, respondents, block_rows):
+            n = min(block_rows, respondents - row_n)
+
+            block = np.empty((n, len(vars)), dtype=np.int32)
+
+            for i, var in enumerate(vars):
+                if var.question_name == 'PUBID':
+                    block[:, i] = np.arange(row_n + 1, row_n + n + 1)
+                else:
+                    block[:, i] = var.values(rand, n)
+
+                if var.labels:
+                    values, c = np.unique(block[:, i], return_counts=True)
+                    for v, c in zip(values.tolist(), c.tolist()):
+                        counts[i][v] = counts[i].get(v, 0) + c
+
+            np.savetxt(f, block, fmt='%d')
+
+    return counts
+
+
+def _count_line(count, value, label=None):
+    """A value label line, with the count indented by 4 to 8 spaces, as in the codebook"""
+    count = str(count)
+    line = ' ' * min(8, max(4, 8 - len(count))) + count + '{:>8}'.format(value)
+    return line + (' ' + label if label else '')
+
+
+def write_cdb(cdb_file, vars, counts, respondents):
+    """Write the codebook for the variables"""
+
+    rule = '-' * 80
+
+    with open(cdb_file, 'w') as f:
+        for var, var_counts in zip(vars, counts):
+
+            f.write('{:<13}{:<47}Survey Year: {}\n'.format(var.variable_name, '[' + var.question_name + ']',
+                                                           var.survey_year))
+            f.write('  PRIMARY VARIABLE\n\n \n')
+            f.write('             {}\n \n'.format(var.question))
+            f.write('COMMENT: Synthetic variable\n \n')
+
+            if var.labels:
+                for v, label in var.labels.items():
+                    f.write(_count_line(var_counts.get(v, 0), v, label) + '\n')
+            else:
+                # Variables without labels have counts for ranges of values
+                step = max(1, (var.hi - var.lo + 1) // 4)
+                for lo in range(var.lo, var.hi + 1, step):
+                    f.write(_count_line(0, lo, 'TO {}'.format(min(var.hi, lo + step - 1))) + '\n')
+
+            n_valid = sum(c for v, c in var_counts.items() if v >= 0) if var.labels else respondents
+
+            f.write('  -------\n{:>8}\n \n'.format(n_valid))
+            f.write('Refusal(-1)            0\nDon\'t Know(-2)         0\n')
+            f.write('TOTAL =========>{:>8}   VALID SKIP(-4)       0     NON-INTERVIEW(-5)       0\n \n'
+                    .format(n_valid))
+
+            if not var.labels:
+                f.write('Min:{:>15}        Max:{:>15}        Mean:{:>20}\n \n'.format(var.lo, var.hi,
+                                                                                  (var.lo + var.hi) / 2))
+
+            f.write(rule + '\n')
+
+
+def write_synthetic(directory, name='synthetic', respondents=1000, variables=500, label_sets=50, years=5,
+                    dims=2, seed=0):
+    """Write a synthetic NLSY97 download, <name>.dat, <name>.cdb and <name>.NLSY97, to a directory,
+    and return the paths of the .dat, .cdb and header files.
+
+    See make_variables() for the parameters"""
+
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    dat_file = directory.joinpath(name + '.dat')
+    cdb_file = directory.joinpath(name + '.cdb')
+    header_file = directory.joinpath(name + '.NLSY97')
+
+    vars = make_variables(respondents, variables, label_sets, years=years, dims=dims, seed=seed)
+
+    counts = write_dat(dat_file, vars, respondents, seed=seed)
+
+    write_cdb(cdb_file, vars, counts, respondents)
+
+    with open(header_file, 'w') as f:
+        f.writelines(var.variable_name.replace('.', '') + '\n' for var in vars)
+
+    return dat_file, cdb_file, header_file
+
+
+def write_archive(archive, files):
+    """Write files to a ZIP archive, as NLS Investigator downloads are packaged"""
+    from zipfile import ZIP_DEFLATED, ZipFile
+
+    with ZipFile(archive, 'w', ZIP_DEFLATED) as zf:
+        for file in files:
+            zf.write(file, Path(file).name)
+
+    return Path(archive)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Write a synthetic NLSY97 download')
+
+    parser.add_argument('-n', '--name', default='synthetic', help='Base name of the files')
+
+    parser.add_argument('-r', '--respondents', type=int, default=1000, help='Number of respondents')
+
+    parser.add_argument('-v', '--variables', type=int, default=500, help='Number of variables')
+
+    parser.add_argument('-l', '--label-sets', type=int, default=50, help='Number of distinct label sets')
+
+    parser.add_argument('-y', '--years', type=int, default=5, help='Maximum number of survey years per question')
+
+    parser.add_argument('-d', '--dims', type=int, default=2, help='Maximum number of dimensions per question')
+
+    parser.add_argument('-s', '--seed', type=int, default=0, help='Random seed')
+
+    parser.add_argument('-z', '--zip', action='store_true', help='Also package the files in a ZIP archive')
+
+    parser.add_argument('directory', help='Directory to write the files to')
+
+    args = parser.parse_args()
+
+    files = write_synthetic(args.directory, args.name, args.respondents, args.variables, args.label_sets,
+                            args.years, args.dims, args.seed)
+
+    if args.zip:
+        files = [write_archive(Path(args.directory).joinpath(args.name + '.zip'), files)]
+
+    for f in files:
+        print("Wrote ", f)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,8 @@
 
 
+import unittest
+from pathlib import Path
+
 from rowgenerators.test import RowGeneratorTest
 from rowgenerators import parse_app_url
 
@@ -42,7 +45,837 @@ class NlsyTest(RowGeneratorTest):
             #df = df[df['CV_CHILD_BIRTH_DATE~M']>=0]
             print(df.reset_index().head().T)
 
-import unittest
+
+class NlsyConvertTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        from os.path import join, dirname
+        from tempfile import mkdtemp
+        from zipfile import ZipFile
+
+        cls.test_dir = Path(mkdtemp())
+
+        with ZipFile(join(dirname(__file__), 'test_data', 'test-package.zip')) as zf:
+            zf.extractall(cls.test_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        from shutil import rmtree
+        rmtree(cls.test_dir)
+
+    def test_convert_nlsy(self):
+        import h5py
+        import numpy as np
+        from publicdata.nlsy.h5 import convert_nlsy
+        from publicdata.nlsy.store import Hdf5Store
+
+        dat_file = self.test_dir.joinpath('test-package.dat')
+        h5_file = self.test_dir.joinpath('test-package.h5')
+
+        expected = np.loadtxt(dat_file, dtype=np.int32)
+
+        for layout in ('row', 'column'):
+            for downcast in (False, True):
+                # Use a small block size to exercise the streaming
+                convert_nlsy(dat_file, self.test_dir.joinpath('test-package.NLSY97'), h5_file,
+                             layout=layout, downcast=downcast, block_size=10000)
+
+                with h5py.File(h5_file, 'r') as f:
+                    store = Hdf5Store(f, 'test-package')
+                    self.assertEqual((8984, 28), store.shape)
+
+                    columns = store.read_columns(range(28))
+                    self.assertTrue((np.column_stack(columns) == expected).all())
+
+                    columns = store.read_columns([27, 3, 1, 3])
+                    self.assertTrue((np.column_stack(columns) == expected[:, [27, 3, 1, 3]]).all())
+
+                    if downcast:
+                        self.assertEqual(np.int16, columns[1].dtype)  # Birth year
+                        self.assertEqual(np.int8, columns[2].dtype)  # Sex
+
+                    # Columns in several slabs, with some rows
+                    store.max_gap = 0
+                    columns = store.read_columns([20, 2, 3, 9, 11], rows=slice(100, 200))
+                    self.assertTrue((np.column_stack(columns) == expected[100:200, [20, 2, 3, 9, 11]]).all())
+
+                    # Rows in several slabs
+                    rows = np.array([0, 5, 6, 100, 4000, 8983])
+                    columns = store.read_columns([20, 2, 3, 9, 11], rows=rows)
+                    self.assertTrue((np.column_stack(columns) == expected[rows][:, [20, 2, 3, 9, 11]]).all())
+
+    def test_dat_rows(self):
+        import numpy as np
+        from publicdata.nlsy.h5 import convert_nlsy, count_rows, iter_row_blocks
+
+        dat_dir = self.test_dir.joinpath('dat_rows')
+        dat_dir.mkdir()
+
+        dat_file = dat_dir.joinpath('test-package.dat')
+        header_file = self.test_dir.joinpath('test-package.NLSY97')
+
+        # Blank lines at the end, and in the middle, are not rows
+        text = self.test_dir.joinpath('test-package.dat').read_text()
+        lines = text.splitlines()
+        dat_file.write_text('\n'.join(lines[:100]) + '\n  \n' + '\n'.join(lines[100:]) + '\n\n')
+
+        self.assertEqual(8984, count_rows(dat_file))
+        self.assertEqual(8984, count_rows(dat_file, block_size=1000))  # Lines across blocks
+        self.assertEqual(8984, sum(len(a) for a in iter_row_blocks(dat_file, 28, block_size=10000)))
+
+        for layout in ('row', 'column'):
+            convert_nlsy(dat_file, header_file, dat_file.with_suffix('.h5'), layout=layout)
+
+        # Values that are not integers, or the wrong number of values in a row, are errors
+        dat_file.write_text('1 2 3\n4 x 6\n')
+        with self.assertRaises(ValueError):
+            list(iter_row_blocks(dat_file, 3))
+
+        with self.assertRaises(ValueError):
+            list(iter_row_blocks(dat_file, 2))
+
+        dat_file.write_text('1 2 3\n4 5\n')
+        with self.assertRaises(ValueError):
+            list(iter_row_blocks(dat_file, 3))
+
+        dat_file.write_text('1 2 3\n4 5 6')
+        self.assertEqual(2, count_rows(dat_file))
+        self.assertTrue((np.array([[1, 2, 3], [4, 5, 6]]) == next(iter_row_blocks(dat_file, 3))).all())
+
+    def test_chunk_cache(self):
+        import h5py
+        import numpy as np
+        from publicdata.nlsy.h5 import chunk_cache_size, convert_nlsy
+        from publicdata.nlsy.nlsy import NLSY97
+
+        with h5py.File('chunk_cache.h5', 'w', driver='core', backing_store=False) as f:
+            ds = f.create_dataset('survey', (10000, 1000), dtype=np.int32, chunks=(100, 100))
+
+            # 256 columns are in 3 columns of chunks, across 100 rows of chunks, of 40,000 bytes each
+            self.assertEqual({'rdcc_nbytes': 300 * 40000, 'rdcc_nslots': 30001, 'rdcc_w0': 0.75},
+                             chunk_cache_size(ds))
+
+            self.assertEqual(100 * 40000, chunk_cache_size(ds, columns=1)['rdcc_nbytes'])
+            self.assertEqual(2 ** 24, chunk_cache_size(ds, columns=1, min_bytes=2 ** 24)['rdcc_nbytes'])
+            self.assertEqual(2 ** 24, chunk_cache_size(ds, columns=1000, max_bytes=2 ** 24)['rdcc_nbytes'])
+
+            ds.attrs['layout'] = 'column'
+            self.assertEqual(1.0, chunk_cache_size(ds)['rdcc_w0'])
+
+        h5_file = self.test_dir.joinpath('chunk_cache', 'test-package.h5')
+        h5_file.parent.mkdir()
+
+        convert_nlsy(self.test_dir.joinpath('test-package.dat'), self.test_dir.joinpath('test-package.NLSY97'),
+                     h5_file)
+
+        with h5py.File(h5_file, 'r') as f:
+            auto = chunk_cache_size(f['test-package'])
+
+        def cache_config(nlsy):
+            _, nslots, nbytes, w0 = nlsy.f.id.get_access_plist().get_cache()
+            return {'rdcc_nbytes': nbytes, 'rdcc_nslots': nslots, 'rdcc_w0': w0}
+
+        with NLSY97(h5_file) as nlsy:
+            self.assertEqual(auto, cache_config(nlsy))
+
+        explicit = {'rdcc_nbytes': 2 ** 22, 'rdcc_nslots': 10007, 'rdcc_w0': 0.5}
+
+        with NLSY97(h5_file, chunk_cache=explicit) as nlsy:
+            self.assertEqual(explicit, cache_config(nlsy))
+
+        # The h5py defaults
+        with h5py.File(h5_file, 'r') as f:
+            default = f.id.get_access_plist().get_cache()
+
+        with NLSY97(h5_file, chunk_cache=None) as nlsy:
+            self.assertEqual(default, nlsy.f.id.get_access_plist().get_cache())
+
+    def test_coalesce(self):
+        from publicdata.nlsy.store import coalesce
+
+        self.assertEqual([(0, 3), (7, 8), (20, 21)], coalesce([0, 1, 2, 7, 20], max_gap=3))
+        self.assertEqual([(0, 8), (20, 21)], coalesce([0, 1, 2, 7, 20], max_gap=4))
+        self.assertEqual([(0, 3), (7, 8), (20, 21)], coalesce([0, 2, 7, 20], max_gap=1))
+
+        # Positions in the same chunk are read together, however far apart
+        self.assertEqual([(0, 8), (20, 21)], coalesce([0, 7, 20], chunk_cols=10, max_gap=0))
+        self.assertEqual([(9, 10), (10, 11)], coalesce([9, 10], chunk_cols=10, max_gap=-1))
+        self.assertEqual([], coalesce([]))
+
+    def test_column_cache(self):
+        import h5py
+        import numpy as np
+        from publicdata.nlsy.h5 import convert_nlsy
+        from publicdata.nlsy.store import ColumnCache, Hdf5Store
+
+        h5_file = self.test_dir.joinpath('column_cache', 'test-package.h5')
+        h5_file.parent.mkdir()
+
+        convert_nlsy(self.test_dir.joinpath('test-package.dat'), self.test_dir.joinpath('test-package.NLSY97'),
+                     h5_file, downcast=False)
+
+        expected = np.loadtxt(self.test_dir.joinpath('test-package.dat'), dtype=np.int32)
+
+        with h5py.File(h5_file, 'r') as f:
+            store = Hdf5Store(f, 'test-package')
+
+            reads = []
+            read_columns = store.read_columns
+            store.read_columns = lambda col_nos, rows=None: reads.append(list(col_nos)) or read_columns(col_nos, rows)
+
+            col_bytes = 8984 * 4
+            cache = ColumnCache(store, max_bytes=3 * col_bytes)
+
+            columns = cache.read_columns([1, 2])
+            self.assertTrue((np.column_stack(columns) == expected[:, [1, 2]]).all())
+            self.assertFalse(columns[0].flags.writeable)
+
+            # Only the missing column is read
+            columns = cache.read_columns([2, 3, 2])
+            self.assertTrue((np.column_stack(columns) == expected[:, [2, 3, 2]]).all())
+            self.assertEqual([[1, 2], [3]], reads)
+
+            # Column 1 is the least recently used, so it is evicted
+            cache.read_columns([4])
+            self.assertEqual([3, 2, 4], list(cache.columns))
+            self.assertEqual(3 * col_bytes, cache.nbytes)
+
+            cache.read_columns([1, 2])
+            self.assertEqual([1], reads[-1])
+            self.assertEqual([4, 1, 2], list(cache.columns))
+            self.assertEqual((3, 5), (cache.hits, cache.misses))
+
+            # Selections of rows are made from the cached columns, and the missing columns
+            # are read with only those rows, and not cached
+            rows = np.array([3, 50, 7000])
+            columns = cache.read_columns([2, 5], rows=rows)
+            self.assertTrue((np.column_stack(columns) == expected[rows][:, [2, 5]]).all())
+            self.assertEqual([5], reads[-1])
+            self.assertEqual([4, 1, 2], list(cache.columns))
+            self.assertEqual((4, 6), (cache.hits, cache.misses))
+
+            # With a limit of 0, nothing is cached
+            uncached = ColumnCache(store, 0)
+            uncached.read_columns([5, 6])
+            self.assertEqual([5, 6], reads[-1])
+            self.assertEqual(0, len(uncached.columns))
+
+    def test_archive(self):
+        import h5py
+        import numpy as np
+        from os.path import join, dirname
+        from publicdata.nlsy.archive import find_member
+        from publicdata.nlsy.h5 import convert_nlsy
+        from publicdata.nlsy.store import Hdf5Store
+
+        archive = join(dirname(__file__), 'test_data', 'test-package.zip')
+        extract_dir = self.test_dir.joinpath('archive')
+
+        dat_file = find_member(archive, '.dat', extract_dir)
+        header_file = find_member(archive, '.NLSY97', extract_dir)
+
+        self.assertEqual(extract_dir.joinpath('test-package.dat'), Path(dat_file))
+        self.assertEqual(header_file, dat_file.with_suffix('.NLSY97'))
+        self.assertFalse(Path(dat_file).exists())
+
+        with self.assertRaises(FileNotFoundError):
+            find_member(archive, '.NLSY79')
+
+        h5_file = Path(dat_file).with_suffix('.h5')
+        h5_file.parent.mkdir()
+
+        convert_nlsy(dat_file, header_file, h5_file, block_size=10000)
+
+        expected = np.loadtxt(self.test_dir.joinpath('test-package.dat'), dtype=np.int32)
+
+        with h5py.File(h5_file, 'r') as f:
+            store = Hdf5Store(f, 'test-package')
+            self.assertTrue((np.column_stack(store.read_columns(range(28))) == expected).all())
+
+    def test_synthetic(self):
+        import numpy as np
+        from publicdata.nlsy.benchmark import bench_suite
+        from publicdata.nlsy.cdb import extract_from_codebook
+        from publicdata.nlsy.synthetic import write_synthetic
+
+        dat_file, cdb_file, header_file = write_synthetic(self.test_dir.joinpath('synthetic'),
+                                                          respondents=50, variables=120, label_sets=5)
+
+        data = np.loadtxt(dat_file, dtype=np.int32)
+        self.assertEqual((50, 120), data.shape)
+        self.assertEqual(list(range(1, 51)), list(data[:, 0]))
+
+        self.assertEqual(120, len(header_file.read_text().splitlines()))
+
+        codeb = extract_from_codebook(cdb_file, force=True)
+        self.assertEqual(['PUBID', 'KEY!SEX', 'KEY!BDATE_Y'], [e['question_name'] for e in codeb[:3]])
+        self.assertEqual(['1 Male', '2 Female'], [e.split(None, 1)[1].strip() for e in codeb[1]['label_lines']])
+
+        results = bench_suite([dict(respondents=50, variables=120, label_sets=5)], n=3,
+                              work_dir=self.test_dir)
+
+        self.assertEqual(['convert_nlsy', 'extract_from_codebook', 'convert_cdb', 'load_metadata',
+                          'get_dataframe', 'question_dataframe', 'categoricalize'], [e['stage'] for e in results])
+        self.assertEqual(3, results[-1]['calls'])
+
+    def test_extract_parallel(self):
+        from publicdata.nlsy.cdb import extract_from_codebook
+        from publicdata.nlsy.synthetic import write_synthetic
+
+        _, cdb_file, _ = write_synthetic(self.test_dir.joinpath('parallel'), respondents=10, variables=300)
+
+        serial = extract_from_codebook(cdb_file, force=True)
+
+        for chunk_bytes in (1000, 20000):
+            parallel = extract_from_codebook(cdb_file, force=True, jobs=3, chunk_bytes=chunk_bytes)
+            self.assertEqual(serial, parallel)
+
+        self.assertEqual(list(range(1, 301)), [e['var_no'] for e in parallel[:300]])
+
+    def test_codebook_cache(self):
+        import shutil
+        from publicdata.nlsy.cdb import _extract_from_codebook, extract_from_codebook
+
+        cdb_file = self.test_dir.joinpath('cache', 'test-package.cdb')
+        cdb_file.parent.mkdir()
+        shutil.copy(self.test_dir.joinpath('test-package.cdb'), cdb_file)
+
+        with cdb_file.open() as f:
+            expected = _extract_from_codebook(f)
+
+        self.assertEqual(expected, extract_from_codebook(cdb_file))
+        self.assertTrue(cdb_file.with_suffix('.cdb.h5').exists())
+        self.assertEqual(expected, extract_from_codebook(cdb_file))  # From the cache
+
+        self.assertEqual(5, len(extract_from_codebook(cdb_file, limit=100)))  # Limit changes
+
+        # Content changes
+        cdb_file.write_text(cdb_file.read_text().replace('[KEY!SEX]', '[KEY!GENDER]'))
+        self.assertEqual('KEY!GENDER', extract_from_codebook(cdb_file)[1]['question_name'])
+
+    def test_cluster_words(self):
+        import random
+        import stringdist
+        from publicdata.nlsy.cdb_labels import cluster_words, dmeta_sub, slugify
+        from publicdata.nlsy.synthetic import WORDS, _label_variant
+
+        def brute_force(words, thresh=8):
+            # The algorithm cluster_words() implements, comparing every word with every member
+            clusters = []
+            for w1 in words:
+                for cluster in clusters:
+                    ad = sum(stringdist.levenshtein(slugify(w1[0]), slugify(w2[0])) for w2 in cluster) / len(cluster)
+                    if ad < thresh or any(dmeta_sub(w1[0], w2[0]) < thresh for w2 in cluster):
+                        cluster.add(w1)
+                        break
+                else:
+                    clusters.append({w1})
+            return clusters
+
+        # Short labels are all close, the long one is only close to 'Yes' by its metaphone keys
+        self.assertEqual([{('Yes', 1), ('YES', 2), ('No', 3), ('no', 4)}, {('Yes (Go To R00001.00)', 5)}],
+                         cluster_words([('Yes', 1), ('YES', 2), ('No', 3), ('no', 4), ('Yes (Go To R00001.00)', 5)]))
+
+        rand = random.Random(0)
+
+        for _ in range(200):
+            labels = [' '.join(rand.sample(WORDS, rand.randint(1, 3))) for _ in range(rand.randint(1, 5))]
+            words = [(_label_variant(rand, rand.choice(labels)), i) for i in range(rand.randint(1, 30))]
+
+            for thresh in (8, 2):
+                self.assertEqual(brute_force(words, thresh), cluster_words(words, thresh))
+
+    def test_label_lines(self):
+        from publicdata.nlsy.cdb_labels import join_label_lines, markup_label_lines, split_lines
+
+        label_lines = [
+            ['     123       1 Yes (Go To R00012.00)', '     456       0 No'],
+            ['      12       0 TO 10', '       5      11 TO 99: Some', '     continued label'],
+            ['     100       1 Other - Recoded to something'],
+            ['      10       3 A label that is quite long: more'],
+            []
+        ]
+
+        self.assertEqual([[('1', 'Yes'), ('0', 'No')],
+                          [('0-10', ''), ('11-99', 'Some continued label')],
+                          [('1', 'Something')],
+                          [('3', 'A label that is quite long: more')],
+                          []],
+                         [list(split_lines(markup_label_lines(join_label_lines(lines)))) for lines in label_lines])
+
+    def test_remap_parallel(self):
+        from publicdata.nlsy.cdb import extract_from_codebook
+        from publicdata.nlsy.cdb_labels import LabelFeatureStore, generate_remap_rows, process_value_labels
+        from publicdata.nlsy.synthetic import write_synthetic
+
+        _, cdb_file, _ = write_synthetic(self.test_dir.joinpath('remap'), respondents=10, variables=300)
+
+        procd = list(process_value_labels(extract_from_codebook(cdb_file)))
+
+        serial = list(generate_remap_rows(procd, LabelFeatureStore()))
+        self.assertTrue(serial)
+
+        features = LabelFeatureStore()
+        self.assertEqual(serial, list(generate_remap_rows(procd, features, jobs=2)))
+
+        # Features computed in the workers are merged back into the parent's store
+        self.assertTrue(features.added)
+        self.assertEqual(len(features), features.added)
+
+    def test_label_features(self):
+        from publicdata.nlsy.cdb_labels import LabelFeatureStore, compute_features
+
+        path = self.test_dir.joinpath('features.h5')
+        labels = ['Yes', 'YES (Go To R00001.00)', '', '1997', 'h x 1', 'Ñandú', None]
+
+        store = LabelFeatureStore(path)
+        for label in labels + labels:
+            store[label]
+
+        self.assertEqual(len(labels), store.added)
+        self.assertEqual(None, store['h x 1'].keys)  # Some words have no key
+        store.save()
+
+        store = LabelFeatureStore(path)
+        self.assertEqual(len(labels), len(store))
+        self.assertEqual([compute_features(e) for e in labels], [store[e] for e in labels])
+        self.assertEqual(0, store.added)
+
+    def test_label_sets(self):
+        import pandas as pd
+        from publicdata.nlsy.cdb import LabelSets, convert_cdb
+
+        ls = LabelSets()
+        self.assertEqual(0, ls.intern({'1': 'Yes', '0': 'No'}, 0, 1))
+        self.assertEqual(1, ls.intern({'1': 'Male', '2': 'Female'}, 0, 1))
+        self.assertEqual(0, ls.intern({'0': 'NO', '1': 'yes'}, 0, 1))  # Same content, after slugifying
+        self.assertEqual({'0': 'NO', '1': 'yes'}, ls.labels[0][0])
+
+        convert_cdb(self.test_dir.joinpath('test-package.cdb'), csv=True)
+        meta = pd.read_csv(self.test_dir.joinpath('test-package.meta.csv'))
+
+        # Label set 0 is categorical, like the others
+        self.assertEqual([1], list(meta[meta.labels_id == 0].is_categorical.unique()))
+        self.assertEqual({0, 1, 2}, set(meta.labels_id.dropna()))
+
+    def test_metadata(self):
+        from unittest import mock
+
+        import h5py
+        import pandas as pd
+        from publicdata.nlsy.cdb import META_TABLES, convert_cdb
+        from publicdata.nlsy.h5 import convert_nlsy, load_metadata, read_table
+        from publicdata.nlsy.nlsy import NLSY97
+        from publicdata.nlsy.store import ColumnIndex
+
+        dat_file = self.test_dir.joinpath('metadata', 'test-package.dat')
+        dat_file.parent.mkdir()
+
+        for suffix in ('.dat', '.cdb', '.NLSY97'):
+            _copy_file(self.test_dir.joinpath('test-package' + suffix), dat_file.with_suffix(suffix))
+
+        files = convert_cdb(dat_file.with_suffix('.cdb'), csv=True)
+        self.assertEqual(dat_file.with_suffix('.meta.h5'), files[0])
+
+        convert_nlsy(dat_file, dat_file.with_suffix('.NLSY97'), dat_file.with_suffix('.h5'))
+        load_metadata(dat_file)
+
+        # The tables have the types they would have if they were loaded from the CSV files
+        with h5py.File(dat_file.with_suffix('.h5'), 'r') as f:
+            for table, suffix in META_TABLES.items():
+                csv_table = pd.read_csv(dat_file.with_suffix(suffix), low_memory=False)
+                t = read_table(f, 'test-package_' + table)
+
+                self.assertEqual(list(csv_table.columns), list(t.columns))
+                for c in t.columns:
+                    self.assertEqual(list(csv_table[c].astype(object).where(csv_table[c].notna(), None)),
+                                     list(t[c].astype(object).where(t[c].notna(), None)), c)
+
+            # Label set 0 is a label set like the others, so KEY!SEX, which has it, is categorical
+            t = read_table(f, 'test-package_variable_labels').set_index('question_name')
+            self.assertEqual(0, t.at['KEY!SEX', 'labels_id'])
+            self.assertEqual(1, t.at['KEY!SEX', 'is_categorical'])
+            self.assertEqual(list(t.labels_id.notna().astype(int)), list(t.is_categorical))
+
+        # Names are looked up in the column index, which has the same names as the column map
+        with NLSY97(dat_file.with_suffix('.h5')) as nlsy:
+            index = nlsy.column_index
+            self.assertTrue(isinstance(nlsy.store.column_index(), ColumnIndex))
+            self.assertEqual(dict(nlsy.column_map), dict(index.items()))
+
+            # Headers are read once
+            self.assertEqual(28, len(nlsy.store.headers))
+            self.assertIs(nlsy.store.headers, nlsy.store.headers)
+
+            # Dataframes of cached columns are made without reading the file
+            df = nlsy.get_dataframe(['KEY!SEX', 'PUBID'])
+            with mock.patch.object(h5py.Group, '__getitem__', side_effect=AssertionError('File read')):
+                self.assertTrue(df.equals(nlsy.get_dataframe(['KEY!SEX', 'PUBID'])))
+
+            self.assertEqual(1, index.get('KEY!SEX'))
+            self.assertEqual(1, index.get('R05363.00'))
+            self.assertIsNone(index.get('KEY!SEXY'))
+
+            self.assertEqual({'R05363.00': 1, 'R0536300': 1, 'R05364.01': 2, 'R05364.02': 3, 'R0536401': 2,
+                              'R0536402': 3}, index.prefix('R05'))
+            self.assertEqual(['YIR-520~000001', 'YIR-520~000002', 'YIR-520~000003'], list(index.glob('YIR-520~*')))
+
+            self.assertEqual(['R0000100', 'R5161200', 'R6889500', 'R6889501', 'R6889502'],
+                             list(nlsy.get_dataframe(['YIR-520*', 'PUBID']).columns))
+
+            # Respondent predicates select rows before the other columns are read
+            df = nlsy.get_dataframe(['YIR-520*', 'KEY!SEX'])
+            sub = nlsy.get_dataframe(['YIR-520*', 'KEY!SEX'], where={'KEY!SEX': 2})
+            self.assertTrue(df[df.R0536300 == 2].equals(sub))
+            self.assertEqual(list(sub.index), list(nlsy.select_rows(lambda r: r['KEY!SEX'] == 2)))
+
+            sub = nlsy.get_dataframe(['PUBID'], where={'PUBID': [5, 10, 8000]})
+            self.assertEqual([5, 10, 8000], list(sub.R0000100))
+
+            # Dataframes made from cached columns are copies, so they can be changed
+            for where in (None, {'KEY!SEX': 2}):
+                df = nlsy.get_dataframe(['PUBID', 'KEY!SEX'], where=where)
+                df.iloc[0, 0] = -7
+                df.loc[df.R0536300 == 1, 'R0536300'] = 0
+                self.assertNotEqual(-7, nlsy.get_dataframe(['PUBID'], where=where).iloc[0, 0])
+
+            qdf = nlsy.question_dataframe('YSCH-24400').drop(columns='index')
+            sub = nlsy.question_dataframe('YSCH-24400', where={'KEY!SEX': 2}).drop(columns='index')
+            self.assertTrue(qdf[qdf['KEY!SEX'] == 2].reset_index(drop=True)[sub.columns].equals(sub))
+
+            # Questions are exported one at a time, to a file per question, or per question and year
+            files = nlsy.export_questions(self.test_dir.joinpath('questions'))
+            self.assertEqual(nlsy.base_questions, list(files))
+            self.assertTrue(pd.read_parquet(files['YSCH-24400'][0]).equals(nlsy.question_dataframe('YSCH-24400')))
+
+            files = nlsy.export_questions(self.test_dir.joinpath('years'), ['YIR-520', 'KEY!SEX'],
+                                          partition='survey_year')
+            self.assertEqual(['1998.parquet', '1999.parquet', '2000.parquet'], [f.name for f in files['YIR-520']])
+
+            df = pd.concat([pd.read_parquet(f) for f in files['YIR-520']], ignore_index=True)
+            qdf = nlsy.question_dataframe('YIR-520')
+            self.assertTrue(qdf.sort_values(['survey_year', 'index']).reset_index(drop=True).equals(df))
+            self.assertIn('KEY!SEX', pd.read_parquet(files['KEY!SEX'][0]).columns)
+
+            # Exports don't use, or change, the column cache, even if they are abandoned
+            cached = list(nlsy.column_cache.columns)
+            self.assertTrue(cached)
+
+            next(nlsy.iter_question_dataframes(['CV_SAMPLE_TYPE', 'YIR-520']))
+            self.assertEqual(cached, list(nlsy.column_cache.columns))
+            self.assertNotIn(nlsy.column_index.get('CV_SAMPLE_TYPE'), nlsy.column_cache.columns)
+            self.assertEqual(2 ** 30, nlsy.column_cache.max_bytes)
+
+            # Exports replace the files of the questions from earlier exports, in either layout
+            years_dir = self.test_dir.joinpath('years')
+            nlsy.export_questions(years_dir, ['YIR-520'])
+            self.assertEqual(cached, list(nlsy.column_cache.columns))
+
+            self.assertEqual(['KEY!SEX', 'YIR-520.parquet'], sorted(f.name for f in years_dir.iterdir()))
+
+            nlsy.export_questions(years_dir, ['YIR-520', 'KEY!SEX'], partition='survey_year')
+            self.assertEqual(['KEY!SEX', 'YIR-520'], sorted(f.name for f in years_dir.iterdir()))
+            self.assertEqual(['1998.parquet', '1999.parquet', '2000.parquet'],
+                             sorted(f.name for f in years_dir.joinpath('YIR-520').iterdir()))
+
+    def _metadata_h5(self, name):
+        """Convert the test package, with metadata, in a new directory, and return the path to the HDF5 file"""
+        from publicdata.nlsy.cdb import convert_cdb
+        from publicdata.nlsy.h5 import convert_nlsy, load_metadata
+
+        dat_file = self.test_dir.joinpath(name, 'test-package.dat')
+        dat_file.parent.mkdir()
+
+        for suffix in ('.dat', '.cdb', '.NLSY97'):
+            _copy_file(self.test_dir.joinpath('test-package' + suffix), dat_file.with_suffix(suffix))
+
+        convert_cdb(dat_file.with_suffix('.cdb'))
+        convert_nlsy(dat_file, dat_file.with_suffix('.NLSY97'), dat_file.with_suffix('.h5'))
+        load_metadata(dat_file)
+
+        return dat_file.with_suffix('.h5')
+
+    def test_parquet(self):
+        import h5py
+        import numpy as np
+        from publicdata.nlsy import NlsyError
+        from publicdata.nlsy.nlsy import NLSY97
+        from publicdata.nlsy.parquet import convert_parquet
+        from publicdata.nlsy.store import Hdf5Store, ParquetStore
+
+        h5_file = self._metadata_h5('parquet')
+
+        parquet_dir = convert_parquet(h5_file, row_group_bytes=2 ** 16)
+        self.assertEqual(h5_file.with_suffix('.parquet'), parquet_dir)
+
+        store = ParquetStore(parquet_dir)
+
+        with h5py.File(h5_file, 'r') as f:
+            h5_store = Hdf5Store(f, 'test-package')
+
+            self.assertEqual(h5_store.shape, store.shape)
+            self.assertEqual(h5_store.headers, store.headers)
+            self.assertEqual(h5_store.dtypes, store.dtypes)
+
+            for rows in (None, slice(100, 200), slice(None, None, 7), slice(-50, None), slice(-10, -20),
+                         np.array([0, 5, 6, 100, 8983])):
+                for a, b in zip(h5_store.read_columns([27, 3, 1, 3], rows), store.read_columns([27, 3, 1, 3], rows)):
+                    self.assertEqual(a.dtype, b.dtype)
+                    self.assertTrue((a == b).all(), rows)
+
+        # With backend='parquet', the path to the HDF5 file is to the Parquet directory next to it
+        for path in (parquet_dir, h5_file):
+            with NLSY97(h5_file) as h5_nlsy, NLSY97(path, backend='parquet') as nlsy:
+                self.assertTrue(isinstance(nlsy.store, ParquetStore))
+
+                self.assertTrue(h5_nlsy.question_dataframe('YIR-520').equals(nlsy.question_dataframe('YIR-520')))
+
+                where = {'KEY!SEX': 2}
+                self.assertTrue(h5_nlsy.question_dataframe('YSCH-24400', where=where)
+                                .equals(nlsy.question_dataframe('YSCH-24400', where=where)))
+
+        with self.assertRaises(NlsyError):
+            NLSY97(self.test_dir.joinpath('test-package.h5'), backend='parquet')
+
+    def test_mmap(self):
+        import h5py
+        import numpy as np
+        from publicdata.nlsy.h5 import convert_mmap, convert_nlsy
+        from publicdata.nlsy.nlsy import NLSY97
+        from publicdata.nlsy.store import Hdf5Store, MmapStore
+
+        h5_file = self._metadata_h5('mmap')
+
+        column_h5_file = self.test_dir.joinpath('mmap', 'column', 'test-package.h5')
+        column_h5_file.parent.mkdir()
+        convert_nlsy(self.test_dir.joinpath('test-package.dat'), self.test_dir.joinpath('test-package.NLSY97'),
+                     column_h5_file, layout='column')
+
+        def is_mapped(a):
+            while isinstance(a, np.ndarray):
+                if isinstance(a, np.memmap):
+                    return True
+                a = a.base
+            return False
+
+        for path in (h5_file, column_h5_file):
+            # A small block size to write in several slabs
+            mmap_dir = convert_mmap(path, block_size=2 ** 12)
+            self.assertEqual(path.with_suffix('.mmap'), mmap_dir)
+
+            with h5py.File(path, 'r') as f:
+                h5_store = Hdf5Store(f, 'test-package')
+                store = MmapStore(f, 'test-package', mmap_dir)
+
+                for itemsize, ds in h5_store.datasets.items():
+                    a = np.load(mmap_dir.joinpath(f'{ds.dtype.name}.npy'))
+                    self.assertTrue(a.flags.f_contiguous)
+                    self.assertEqual(ds.dtype, a.dtype)
+                    self.assertTrue((ds[:] == a).all())
+
+                self.assertEqual(h5_store.shape, store.shape)
+
+                col_nos = [27, 3, 1, 3]
+                for a, b in zip(h5_store.read_columns(col_nos), store.read_columns(col_nos)):
+                    self.assertEqual(a.dtype, b.dtype)
+                    self.assertTrue((a == b).all())
+
+                # Columns are read-only views of the mapping, not copies
+                for c, a in zip(col_nos, store.read_columns(col_nos, rows=slice(10, 20))):
+                    self.assertTrue(is_mapped(a))
+                    self.assertFalse(a.flags.writeable)
+                    self.assertTrue(np.shares_memory(a, store.datasets[store.col_dtype[c]]))
+
+                rows = np.array([0, 5, 8983])
+                for a, b in zip(h5_store.read_columns(col_nos, rows), store.read_columns(col_nos, rows)):
+                    self.assertTrue((a == b).all())
+
+        with NLSY97(h5_file) as h5_nlsy, NLSY97(h5_file, backend='mmap') as nlsy:
+            self.assertTrue(isinstance(nlsy.store, MmapStore))
+
+            # Dataframes are views of the mapping
+            df = nlsy.get_dataframe(['KEY!SEX'])
+            self.assertTrue(np.shares_memory(df.R0536300.to_numpy(), nlsy.store.datasets[nlsy.store.col_dtype[1]]))
+
+            self.assertTrue(h5_nlsy.question_dataframe('YIR-520').equals(nlsy.question_dataframe('YIR-520')))
+
+            where = {'KEY!SEX': 2}
+            self.assertTrue(h5_nlsy.question_dataframe('YSCH-24400', where=where)
+                            .equals(nlsy.question_dataframe('YSCH-24400', where=where)))
+
+    def test_tables(self):
+        import h5py
+        import numpy as np
+        import pandas as pd
+        from publicdata.nlsy.h5 import read_table, write_table
+
+        df = pd.DataFrame({
+            'col_no': [0, 1, 2],
+            'labels_id': [np.nan, 0, 300],
+            'weight': [.5, np.nan, 1.5],
+            'base_qn': ['PUBID', None, 'YSCH-24400'],
+            'survey_year': ['1997', 'XRND', '1997']
+        })
+
+        with h5py.File(self.test_dir.joinpath('tables.h5'), 'w') as f:
+            write_table(f, 'meta', df)
+
+            self.assertEqual(np.int8, f['meta/col_no'].dtype)
+            self.assertEqual(np.int16, f['meta/labels_id'].dtype)
+
+            t = read_table(f, 'meta')
+            self.assertEqual(list(df.columns), list(t.columns))
+            self.assertTrue(np.isnan(t.labels_id[0]))
+            self.assertEqual([0, 300], list(t.labels_id[1:]))
+            self.assertTrue(pd.isna(t.base_qn[1]))
+            self.assertEqual(['1997', 'XRND', '1997'], list(t.survey_year))
+
+            t = read_table(f, 'meta', ['survey_year', 'col_no'], categorical=True)
+            self.assertEqual(['survey_year', 'col_no'], list(t.columns))
+            self.assertEqual(2, len(t.survey_year.cat.categories))
+
+
+    def test_build(self):
+        from publicdata.nlsy.build import Build, Stage
+
+        in_file = self.test_dir.joinpath('build_in.txt')
+        out_file = self.test_dir.joinpath('build_out.txt')
+        manifest = self.test_dir.joinpath('build.json')
+
+        in_file.write_text('one')
+
+        def make_build(n=1):
+            build = Build(manifest)
+            build.add(Stage('copy', _copy_file, (in_file, out_file), dict(n=n),
+                            inputs=[in_file], outputs=[out_file]))
+            build.add(Stage('count', _copy_file, (out_file, out_file.with_suffix('.2')),
+                            outputs=[out_file.with_suffix('.2')], deps=['copy']))
+            return build
+
+        self.assertEqual(['copy', 'count'], make_build().run())
+        self.assertEqual([], make_build().run())
+
+        in_file.write_text('two')  # Input changes
+        self.assertEqual(['copy', 'count'], make_build().run())
+        self.assertEqual('two', out_file.read_text())
+
+        self.assertEqual(['copy', 'count'], make_build(n=2).run())  # Parameter changes
+        self.assertEqual(['count'], make_build(n=2).run(['count'], force=True))
+
+        out_file.with_suffix('.2').unlink()  # Output is missing
+        self.assertEqual(['count'], make_build(n=2).run())
+
+        # When a stage runs again with the same key, the stages that depend on it run too
+        out_file.unlink()
+        self.assertEqual(['copy'], make_build(n=2).run(['copy']))
+        self.assertEqual(['count'], make_build(n=2).run())
+        self.assertEqual([], make_build(n=2).run())
+
+        in_file.write_text('three')  # In a process pool
+        events = []
+        build = make_build()
+        self.assertEqual(['copy', 'count'], build.run(jobs=2, cb=lambda name, event, *a: events.append((name, event))))
+        self.assertEqual([('copy', 'start'), ('copy', 'done'), ('count', 'start'), ('count', 'done')], events)
+        self.assertEqual('three', out_file.with_suffix('.2').read_text())
+
+        # Measurements, with the counts the stage function reported
+        self.assertEqual(5, build.metrics['copy']['chars'])
+        self.assertTrue(build.metrics['copy']['wall_time'] >= 0)
+        self.assertTrue({'cpu_time', 'peak_rss', 'read_bytes', 'write_bytes'} <= set(build.metrics['copy']))
+
+        build = make_build()
+        self.assertEqual([], build.run(jobs=2))
+
+        # Stages that didn't run report their measurements from the last time they ran
+        report = build.report()
+        self.assertEqual(['copy', 'count'], list(report['stages']))
+        self.assertFalse(report['stages']['copy']['ran'])
+        self.assertEqual(5, report['stages']['copy']['chars'])
+
+        # More stages are ready than there are processes, so some wait for others to finish
+        build = make_build()
+        for n in range(3):
+            build.add(Stage(f'fan{n}', _copy_file, (out_file, out_file.with_suffix(f'.fan{n}')),
+                            outputs=[out_file.with_suffix(f'.fan{n}')], deps=['copy']))
+
+        events = []
+        self.assertEqual({'fan0', 'fan1', 'fan2'},
+                         set(build.run(jobs=2, cb=lambda name, event, *a: events.append((name, event)))))
+
+        running = 0
+        for name, event in events:
+            running += {'start': 1, 'done': -1}.get(event, 0)
+            self.assertTrue(running <= 2)
+
+        self.assertEqual([], make_build().run(jobs=2))
+
+    def test_build_graph(self):
+        import os
+        from types import SimpleNamespace
+
+        import h5py
+        from publicdata.nlsy.__main__ import build_graph
+
+        graph_dir = self.test_dir.joinpath('graph')
+        graph_dir.mkdir()
+
+        archive = graph_dir.joinpath('test-package.zip')
+        archive.write_bytes(Path(__file__).parent.joinpath('test_data', 'test-package.zip').read_bytes())
+
+        args = SimpleNamespace(layout='row', no_downcast=False, limit=None, jobs=1, export_csv=False,
+                               questions=False, partition='base_qn')
+
+        names = ['hdf', 'extract', 'cdb', 'meta']
+        h5_file = graph_dir.joinpath('test-package', 'test-package.h5')
+
+        def has_metadata():
+            with h5py.File(h5_file, 'r') as f:
+                return 'test-package_variable_labels' in f
+
+        cwd = os.getcwd()
+        os.chdir(graph_dir)  # The outputs are written to a directory named for the archive
+        try:
+            self.assertEqual(names, build_graph(archive, args).run(names))
+            self.assertTrue(has_metadata())
+
+            self.assertEqual([], build_graph(archive, args).run(names))
+
+            # Rewriting the HDF5 file removes the metadata, so it is loaded again
+            h5_file.unlink()
+            self.assertEqual(['hdf', 'meta'], build_graph(archive, args).run(names))
+            self.assertTrue(has_metadata())
+
+            self.assertEqual(['hdf'], build_graph(archive, args).run(['hdf'], force=True))
+            self.assertFalse(has_metadata())
+            self.assertEqual(['meta'], build_graph(archive, args).run(names))
+            self.assertTrue(has_metadata())
+
+            # With -p -M -Q and the default 2 jobs, three stages are ready when 'meta' finishes
+            args.jobs, args.questions = 2, True
+            all_names = names + ['parquet', 'mmap', 'questions']
+
+            self.assertEqual({'parquet', 'mmap', 'questions'},
+                             set(build_graph(archive, args).run(all_names, jobs=args.jobs)))
+
+            for suffix in ('.parquet', '.mmap', '.questions'):
+                self.assertTrue(h5_file.with_suffix(suffix).is_dir(), suffix)
+
+            self.assertTrue(list(h5_file.with_suffix('.questions').glob('*.parquet')))
+            self.assertEqual([], build_graph(archive, args).run(all_names, jobs=args.jobs))
+        finally:
+            os.chdir(cwd)
+
+
+def _copy_file(src, dest, n=1):
+    from publicdata.nlsy.instrument import count
+
+    text = Path(src).read_text() * n
+    count(chars=len(text))
+
+    Path(dest).write_text(text)
+
+
 if __name__ == '__main__':
     unittest.main()
 
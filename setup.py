@@ -28,6 +28,9 @@ setup(
         'stringdist', # For NLSY
         'fredapi' # For FRED
         ],
+    extras_require={
+        'parquet': ['pyarrow'], # For the NLSY Parquet backend
+        },
     entry_points={
         'appurl.urls': [
 